@@ -13,12 +13,14 @@ import json
 import datetime
 from datetime import timedelta
 import re
+import time
 import uuid
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # Import enhanced Empathibot and Scheduler
 from empathibot import Empathibot, CrisisDetector, LanguageHandler, UserSessionManager
 from scheduler import CheckInScheduler
+from mental_health_analyzer import MentalHealthAnalyzer
 
 load_dotenv()
 
@@ -62,94 +64,17 @@ def after_request(response):
     return response
 
 # Mental Health Assessment Tools
-class MentalHealthAnalyzer:
-    def __init__(self):
-        self.phq9_questions = [
-            "Little interest or pleasure in doing things",
-            "Feeling down, depressed, or hopeless",
-            "Trouble falling or staying asleep, or sleeping too much",
-            "Feeling tired or having little energy",
-            "Poor appetite or overeating",
-            "Feeling bad about yourself or that you are a failure",
-            "Trouble concentrating on things",
-            "Moving or speaking slowly, or being fidgety/restless",
-            "Thoughts that you would be better off dead or hurting yourself"
-        ]
-        
-        self.gad7_questions = [
-            "Feeling nervous, anxious, or on edge",
-            "Not being able to stop or control worrying",
-            "Worrying too much about different things",
-            "Trouble relaxing",
-            "Being so restless that it is hard to sit still",
-            "Becoming easily annoyed or irritable",
-            "Feeling afraid as if something awful might happen"
-        ]
-    
-    def analyze_phq9_score(self, scores):
-        total = sum(scores)
-        if total <= 4:
-            return {"level": "minimal", "description": "Minimal depression symptoms"}
-        elif total <= 9:
-            return {"level": "mild", "description": "Mild depression symptoms"}
-        elif total <= 14:
-            return {"level": "moderate", "description": "Moderate depression symptoms"}
-        elif total <= 19:
-            return {"level": "moderately_severe", "description": "Moderately severe depression symptoms"}
-        else:
-            return {"level": "severe", "description": "Severe depression symptoms"}
-    
-    def analyze_gad7_score(self, scores):
-        total = sum(scores)
-        if total <= 4:
-            return {"level": "minimal", "description": "Minimal anxiety symptoms"}
-        elif total <= 9:
-            return {"level": "mild", "description": "Mild anxiety symptoms"}
-        elif total <= 14:
-            return {"level": "moderate", "description": "Moderate anxiety symptoms"}
-        else:
-            return {"level": "severe", "description": "Severe anxiety symptoms"}
-    
-    def analyze_text_sentiment(self, text):
-        # Simple sentiment analysis using keywords
-        positive_words = ['happy', 'good', 'great', 'excellent', 'amazing', 'wonderful', 'fantastic', 'love', 'joy', 'excited']
-        negative_words = ['sad', 'bad', 'terrible', 'awful', 'horrible', 'hate', 'depressed', 'anxious', 'worried', 'scared', 'angry']
-        
-        text_lower = text.lower()
-        positive_count = sum(1 for word in positive_words if word in text_lower)
-        negative_count = sum(1 for word in negative_words if word in text_lower)
-        
-        if positive_count > negative_count:
-            return {"sentiment": "positive", "confidence": min(0.9, (positive_count / max(len(text.split()), 1)) * 10)}
-        elif negative_count > positive_count:
-            return {"sentiment": "negative", "confidence": min(0.9, (negative_count / max(len(text.split()), 1)) * 10)}
-        else:
-            return {"sentiment": "neutral", "confidence": 0.5}
-    
-    def generate_recommendations(self, phq9_result, gad7_result, sentiment_analysis):
-        recommendations = []
-        
-        if phq9_result["level"] in ["moderate", "moderately_severe", "severe"]:
-            recommendations.append("Consider speaking with a mental health professional")
-            recommendations.append("Practice daily self-care activities")
-            recommendations.append("Maintain a regular sleep schedule")
-        
-        if gad7_result["level"] in ["moderate", "severe"]:
-            recommendations.append("Try relaxation techniques like deep breathing")
-            recommendations.append("Consider mindfulness or meditation practices")
-            recommendations.append("Limit caffeine intake")
-        
-        if sentiment_analysis["sentiment"] == "negative":
-            recommendations.append("Engage in activities you enjoy")
-            recommendations.append("Connect with supportive friends or family")
-            recommendations.append("Consider journaling your thoughts")
-        
-        return recommendations
-
 analyzer = MentalHealthAnalyzer()
 
-# Initialize enhanced Empathibot
+# Initialize enhanced Empathibot and warm it up at boot. With GUNICORN_PRELOAD (gunicorn.conf.py)
+# this runs once in the master, and workers share the loaded state copy-on-write. Nothing
+# here may use Firestore, since gRPC can't be forked once it is in use
+warm_up_started = time.perf_counter()
 empathibot = Empathibot(db=db, llm=llm)
+warm_up_timings = {'empathibot_init': (time.perf_counter() - warm_up_started) * 1000}
+warm_up_timings.update(empathibot.warm_up())
+print(f"🔥 Warm-up finished in {(time.perf_counter() - warm_up_started) * 1000:.0f} ms: "
+      + ", ".join(f"{component} {elapsed:.1f} ms" for component, elapsed in warm_up_timings.items()))
 
 # Initialize automated check-in scheduler
 scheduler = CheckInScheduler(db=db, empathibot=empathibot)
@@ -158,6 +83,16 @@ scheduler = CheckInScheduler(db=db, empathibot=empathibot)
 if os.getenv("ENABLE_SCHEDULER", "false").lower() in {"1", "true", "yes"}:
     scheduler.start_scheduler()
 
+def start_lexicon_watcher():
+    """Hot-reload the crisis lexicon file when a reload interval is configured"""
+    lexicon_reload_seconds = int(os.getenv("CRISIS_LEXICON_RELOAD_SECONDS", "0"))
+    if lexicon_reload_seconds > 0:
+        empathibot.crisis_detector.start_lexicon_watcher(lexicon_reload_seconds)
+
+
+# Threads don't survive a fork, so preloaded gunicorn workers call this again in post_fork
+start_lexicon_watcher()
+
 # Web Interface Routes
 @app.route("/")
 def index():
@@ -335,14 +270,10 @@ def get_user_insights(phone_number):
     """Get analytics and insights for a WhatsApp user"""
     try:
         # Get user from phone number
-        users_ref = db.collection('whatsapp_users')
-        query = users_ref.where('phone_number', '==', phone_number).limit(1)
-        users = list(query.stream())
+        user_id = empathibot.session_manager.resolve_user_id(phone_number)
 
-        if not users:
+        if user_id is None:
             return jsonify({"success": False, "error": "User not found"}), 404
-
-        user_id = users[0].id
         insights = empathibot.get_user_insights(user_id)
 
         return jsonify({"success": True, "insights": insights})
@@ -357,14 +288,10 @@ def send_check_in(phone_number):
     """Send a wellness check-in to a user"""
     try:
         # Get user from phone number
-        users_ref = db.collection('whatsapp_users')
-        query = users_ref.where('phone_number', '==', phone_number).limit(1)
-        users = list(query.stream())
+        user_id = empathibot.session_manager.resolve_user_id(phone_number)
 
-        if not users:
+        if user_id is None:
             return jsonify({"success": False, "error": "User not found"}), 404
-
-        user_id = users[0].id
         check_in_message = empathibot.send_check_in(user_id)
 
         # TODO: Send via Twilio (requires Twilio client setup)
@@ -414,15 +341,11 @@ def get_conversation_history(phone_number):
     """Get conversation history for a user"""
     try:
         # Get user from phone number
-        users_ref = db.collection('whatsapp_users')
-        query = users_ref.where('phone_number', '==', phone_number).limit(1)
-        users = list(query.stream())
+        user_id = empathibot.session_manager.resolve_user_id(phone_number)
 
-        if not users:
+        if user_id is None:
             return jsonify({"success": False, "error": "User not found"}), 404
 
-        user_id = users[0].id
-
         # Get conversation history
         limit = request.args.get('limit', 20, type=int)
         messages_ref = db.collection('whatsapp_messages')
@@ -472,6 +395,19 @@ def get_empathibot_stats():
             "total_conversations": messages_count,
             "total_crisis_alerts": crisis_count,
             "active_users_7d": active_users,
+            "crisis_detection_latency": empathibot.crisis_detector.get_latency_stats(),
+            "language_detection_tiers": empathibot.language_handler.get_tier_stats(),
+            "result_caches": {
+                "crisis": empathibot.crisis_detector.get_cache_stats(),
+                "sentiment": empathibot.sentiment_cache.stats()
+            },
+            "user_cache": empathibot.session_manager.sessions.stats(),
+            "history_cache": empathibot.session_manager.history_cache.stats(),
+            "conversation_memories": empathibot.conversation_memories.stats(),
+            "retrieval_memory": (empathibot.session_manager.retrieval_memory.stats()
+                                 if empathibot.session_manager.retrieval_memory else None),
+            "prompt_tokens": empathibot.get_prompt_token_stats(),
+            "firestore_round_trips": empathibot.get_round_trip_stats(),
             "system_status": "operational"
         }
 
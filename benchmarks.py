@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""
+Empathibot Benchmarks
+Latency benchmarks with regression gates for the CPU-bound parts of message processing
+
+Usage:
+    python benchmarks.py --compare-ref main # fail on regressions against main, timed side by side
+    python benchmarks.py                   # report drift against benchmark_baseline.json
+    python benchmarks.py --save-baseline   # record a new baseline on this machine
+    python benchmarks.py --batch-sentiment # also compare batch sentiment at 10k/100k/1M messages
+    python benchmarks.py --memory          # also compare rebuilt and persistent conversation memory
+    python benchmarks.py --chain           # also compare building the LLM chain per message and once
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+from langchain.chains import LLMChain
+from langchain_core.language_models.fake import FakeListLLM
+
+from empathibot import (
+    DEFAULT_LEXICON_PATH,
+    CrisisClassifier,
+    CrisisDetector,
+    CrisisLexicon,
+    ConversationMemory,
+    Empathibot,
+    ResultCache,
+    percentile
+)
+from mental_health_analyzer import MentalHealthAnalyzer
+from sentiment import NEGATIVE_WORDS, POSITIVE_WORDS, SentimentAnalyzer
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+LENGTHS = [10, 100, 1000, 5000]
+BATCH_SIZES = [10000, 100000, 1000000]
+LANGUAGES = ['en', 'es', 'fr']
+HIT_DENSITIES = [0.0, 0.05, 0.2]
+
+FILLER_WORDS = {
+    'en': [
+        'i', 'feel', 'today', 'work', 'was', 'long', 'and', 'my', 'friends', 'said',
+        'that', 'it', 'would', 'get', 'easier', 'but', 'the', 'nights', 'are', 'hard',
+        'sleep', 'family', 'dinner', 'phone', 'week', 'tired', 'really', 'just', 'maybe'
+    ],
+    'es': [
+        'hoy', 'el', 'trabajo', 'fue', 'largo', 'y', 'mis', 'amigos', 'dijeron', 'que',
+        'todo', 'va', 'a', 'mejorar', 'pero', 'las', 'noches', 'son', 'difíciles', 'casa'
+    ],
+    'fr': [
+        "aujourd'hui", 'le', 'travail', 'était', 'long', 'et', 'mes', 'amis', 'ont', 'dit',
+        'que', 'tout', 'ira', 'mieux', 'mais', 'les', 'nuits', 'sont', 'dures', 'maison'
+    ]
+}
+
+AMBIGUOUS_PHRASES = [
+    'i feel anxious', 'so overwhelmed lately', 'what a terrible week', 'i feel like a failure',
+    'i am falling apart', 'breaking down again'
+]
+
+
+def synthetic_messages(count: int, length: int, words: List[str], phrases: List[str],
+                       hit_density: float, seed: int = 42) -> List[str]:
+    """Messages of `length` characters where each slot is a phrase with probability `hit_density`"""
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        parts = []
+        size = 0
+        while size < length:
+            part = rng.choice(phrases) if phrases and rng.random() < hit_density else rng.choice(words)
+            parts.append(part)
+            size += len(part) + 1
+        messages.append(' '.join(parts)[:length])
+    return messages
+
+
+def lexicon_phrases(language: str) -> List[str]:
+    """Crisis lexicon keywords of one language, used as corpus hits"""
+    lexicon = CrisisLexicon.load(DEFAULT_LEXICON_PATH)
+    return [entry['keyword'] for entry in lexicon.entries if entry['language'] == language]
+
+
+def time_calls(func: Callable[[str], object], messages: List[str]) -> List[float]:
+    """Time one call per message, in milliseconds"""
+    timings = []
+    for message in messages:
+        start = time.perf_counter()
+        func(message)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def summarize(rounds: List[List[float]]) -> Dict:
+    """Best p50/p99/throughput over several timed rounds, which filters out scheduler noise"""
+    best = {}
+    for timings in rounds:
+        total_seconds = sum(timings) / 1000
+        current = {
+            'p50_ms': percentile(timings, 50),
+            'p99_ms': percentile(timings, 99),
+            'throughput_per_s': len(timings) / total_seconds if total_seconds else 0.0
+        }
+        for metric, value in current.items():
+            better = max if metric == 'throughput_per_s' else min
+            best[metric] = better(best.get(metric, value), value)
+    return {
+        'p50_ms': round(best['p50_ms'], 4),
+        'p99_ms': round(best['p99_ms'], 4),
+        'throughput_per_s': round(best['throughput_per_s'], 1)
+    }
+
+
+def benchmark_targets() -> Dict[str, Callable[[str], object]]:
+    """The hot paths under benchmark, with result caches off so every round does the work"""
+    empathibot = Empathibot(db=None, llm=FakeListLLM(responses=["ok"]))
+    empathibot.sentiment_cache = ResultCache(max_size=0)
+    fuzzy_detector = CrisisDetector(fuzzy=True, cache_size=0)
+
+    def detect_crisis_fuzzy_cold(text: str) -> Dict:
+        # The corpora reuse a few dozen words, so without this nearly every correction is a cache hit
+        fuzzy_detector.lexicon.fuzzy_index.clear_cache()
+        return fuzzy_detector.detect_crisis(text)
+
+    return {
+        'detect_crisis': CrisisDetector(fuzzy=False, cache_size=0).detect_crisis,
+        'detect_crisis_fuzzy_cold': detect_crisis_fuzzy_cold,
+        'empathibot_sentiment': empathibot._analyze_sentiment,
+        'analyzer_sentiment': MentalHealthAnalyzer().analyze_text_sentiment
+    }
+
+
+def run_benchmarks(count: int, lengths: List[int], languages: List[str],
+                   densities: List[float], rounds: int) -> Dict[str, Dict]:
+    """Run every target over every corpus and return results keyed by case name"""
+    results = {}
+    targets = benchmark_targets()
+    for language in languages:
+        phrases = lexicon_phrases(language)
+        for length in lengths:
+            for density in densities:
+                messages = synthetic_messages(count, length, FILLER_WORDS[language], phrases, density,
+                                              seed=length)
+                for target, func in targets.items():
+                    func(messages[0])  # Warm up outside the timed loop
+                    case = f"{target}/{language}/{length}/{density}"
+                    results[case] = summarize([time_calls(func, messages) for _ in range(rounds)])
+                    print(f"  {case:<40} p50 {results[case]['p50_ms']:.4f} ms | "
+                          f"p99 {results[case]['p99_ms']:.4f} ms | "
+                          f"{results[case]['throughput_per_s']} msg/s")
+    return results
+
+
+def find_regressions(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float,
+                     noise_floor_ms: float = 0.1) -> List[str]:
+    """
+    Compare p50/p99 against a baseline
+
+    A case regresses when a percentile is more than `threshold` (a fraction)
+    slower than the baseline and the difference is above `noise_floor_ms`.
+    """
+    regressions = []
+    for case, current in results.items():
+        previous = baseline.get(case)
+        if not isinstance(previous, dict):
+            continue
+        for metric in ('p50_ms', 'p99_ms'):
+            difference = current[metric] - previous[metric]
+            if difference > noise_floor_ms and current[metric] > previous[metric] * (1 + threshold):
+                regressions.append(
+                    f"{case} {metric}: {previous[metric]:.4f} -> {current[metric]:.4f} ms"
+                )
+    return regressions
+
+
+# Runs inside a source tree (its directory first on sys.path), so that tree's own
+# targets and corpora are timed. Replies are prefixed so import-time output is skipped.
+TREE_WORKER = """
+import gc
+import json
+import sys
+
+import benchmarks
+
+config = json.loads(sys.stdin.readline())
+targets = benchmarks.benchmark_targets()
+cases = {}
+for language in config['languages']:
+    phrases = benchmarks.lexicon_phrases(language)
+    for length in config['lengths']:
+        for density in config['densities']:
+            messages = benchmarks.synthetic_messages(config['count'], length, benchmarks.FILLER_WORDS[language],
+                                                     phrases, density, seed=length)
+            for target, func in targets.items():
+                cases[f"{target}/{language}/{length}/{density}"] = (func, messages)
+print('@@' + json.dumps(sorted(cases)), flush=True)
+warm = set()
+for line in sys.stdin:
+    case = line.strip()
+    func, messages = cases[case]
+    if case not in warm:
+        func(messages[0])
+        warm.add(case)
+    # Like timeit, keep collection pauses out of the timings
+    gc.collect()
+    gc.disable()
+    timings = benchmarks.time_calls(func, messages)
+    gc.enable()
+    print('@@' + json.dumps(timings), flush=True)
+"""
+
+
+class TreeWorker:
+    """A long-lived process timing the benchmark cases of one source tree on request"""
+
+    def __init__(self, tree: str, config: Dict):
+        # Compiled patterns and indexes are built from sets, whose order (and so speed) follows
+        # the string hash seed; both trees get the same one
+        env = dict(os.environ, PYTHONHASHSEED='0')
+        self.process = subprocess.Popen([sys.executable, '-c', TREE_WORKER], cwd=tree, text=True, env=env,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        self.process.stdin.write(json.dumps(config) + '\n')
+        self.process.stdin.flush()
+        self.cases = self._reply()
+
+    def _reply(self):
+        for line in self.process.stdout:
+            if line.startswith('@@'):
+                return json.loads(line[2:])
+        raise RuntimeError(f"Benchmark worker exited with code {self.process.wait()}")
+
+    def time(self, case: str) -> List[float]:
+        self.process.stdin.write(case + '\n')
+        self.process.stdin.flush()
+        return self._reply()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def median_result(results: List[Dict]) -> Dict:
+    """Median of each metric over several worker processes' results for one case"""
+    return {metric: round(statistics.median(result[metric] for result in results), 4) for metric in results[0]}
+
+
+def compare_to_ref(ref: str, config: Dict, rounds: int,
+                   processes: int) -> Tuple[Dict[str, Dict], Dict[str, Dict]]:
+    """
+    Time a git ref and the working tree against each other on this machine
+
+    The ref is checked out in a temporary git worktree and both trees run in
+    `processes` worker processes each. Every round of every case is timed on
+    a ref and a working tree worker back to back, in alternating order, so
+    load that comes and goes hits both sides alike. The same code can still
+    run 1.5x apart in two processes, so each side reports the median over its
+    processes of their best rounds. Cases the ref doesn't have are timed on
+    the working tree alone, so they still count for absolute limits.
+
+    Returns:
+        The ref's results and the working tree's, keyed by case name
+    """
+    tree = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ref_tree = os.path.join(temp_dir, 'ref')
+        subprocess.run(['git', 'worktree', 'add', '--detach', ref_tree, ref], cwd=tree, check=True,
+                       stdout=subprocess.DEVNULL)
+        try:
+            if not os.path.exists(os.path.join(ref_tree, 'benchmarks.py')):
+                print(f"⚠️ {ref} has no benchmarks.py; nothing to compare against")
+                return {}, {}
+            pairs = [(TreeWorker(ref_tree, config), TreeWorker(tree, config)) for _ in range(processes)]
+            try:
+                ref_cases = set(pairs[0][0].cases)
+                cases = pairs[0][1].cases
+                # case -> (ref results, working tree results), one per process
+                summaries = {case: ([], []) for case in cases}
+                for case in cases:
+                    sides = (0, 1) if case in ref_cases else (1,)
+                    for pair in pairs:
+                        timings = ([], [])
+                        for round_index in range(rounds):
+                            for side in (sides if round_index % 2 == 0 else sides[::-1]):
+                                timings[side].append(pair[side].time(case))
+                        for side in sides:
+                            summaries[case][side].append(summarize(timings[side]))
+            finally:
+                for pair in pairs:
+                    for worker in pair:
+                        worker.close()
+        finally:
+            subprocess.run(['git', 'worktree', 'remove', '--force', ref_tree], cwd=tree, check=False)
+
+    baseline = {case: median_result(sides[0]) for case, sides in summaries.items() if sides[0]}
+    results = {case: median_result(sides[1]) for case, sides in summaries.items()}
+    for case in cases:
+        line = f"  {case:<40} p50 {results[case]['p50_ms']:.4f} ms | p99 {results[case]['p99_ms']:.4f} ms"
+        if case in baseline:
+            line += f" (ref {baseline[case]['p50_ms']:.4f} / {baseline[case]['p99_ms']:.4f} ms)"
+        print(line)
+    return baseline, results
+
+
+def benchmark_cascade(count: int, lengths: List[int]):
+    """Report per-stage latency of crisis detection with the classifier stage enabled"""
+    training_texts = synthetic_messages(200, 80, FILLER_WORDS['en'], AMBIGUOUS_PHRASES, 0.3, seed=7) + [
+        ' '.join(random.Random(i).sample(FILLER_WORDS['en'], 10)) for i in range(200)
+    ]
+    labels = [1] * 200 + [0] * 200
+    classifier = CrisisClassifier.train(training_texts, labels, epochs=50)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        classifier_path = os.path.join(temp_dir, 'classifier.npz')
+        classifier.save(classifier_path)
+        detector = CrisisDetector(classifier_path=classifier_path, cache_size=0)
+
+    print("Crisis detection cascade (lexicon + classifier)")
+    for length in lengths:
+        messages = synthetic_messages(count, length, FILLER_WORDS['en'], AMBIGUOUS_PHRASES, 0.1,
+                                      seed=length)
+        time_calls(detector.detect_crisis, messages)
+
+    for stage, stats in detector.get_latency_stats().items():
+        if stats['count']:
+            print(f"  {stage} stage: {stats['count']} calls | p50 {stats['p50_ms']:.4f} ms | "
+                  f"p99 {stats['p99_ms']:.4f} ms")
+
+
+def benchmark_batch_sentiment(sizes: List[int]):
+    """Compare per-message and NumPy batch sentiment scoring of the same messages"""
+    analyzer = SentimentAnalyzer()
+    phrases = list(POSITIVE_WORDS) + list(NEGATIVE_WORDS) + ['not happy', "don't feel good", 'not that bad']
+    print("Batch sentiment (per-message loop vs analyze_many)")
+    for size in sizes:
+        messages = synthetic_messages(size, 80, FILLER_WORDS['en'], phrases, 0.15, seed=size)
+
+        start = time.perf_counter()
+        expected = [analyzer.analyze(message) for message in messages]
+        loop_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = analyzer.analyze_many(messages)
+        batch_seconds = time.perf_counter() - start
+
+        if results != expected:
+            raise AssertionError(f"Batch sentiment differs from per-message results at {size} messages")
+        print(f"  {size:>8} messages: loop {loop_seconds:.2f} s | batch {batch_seconds:.2f} s | "
+              f"{loop_seconds / batch_seconds:.1f}x")
+
+
+def benchmark_conversation_memory(count: int):
+    """Compare rebuilding conversation memory from history per message with updating a live one"""
+    messages = synthetic_messages(count + 10, 100, FILLER_WORDS['en'], AMBIGUOUS_PHRASES, 0.1, seed=3)
+    exchanges = [{'user_message': message, 'bot_response': message[::-1]} for message in messages]
+
+    rebuilt = []
+    for i in range(10, len(exchanges)):
+        start = time.perf_counter()
+        ConversationMemory('user', exchanges[i - 10:i]).get_context_summary()
+        rebuilt.append((time.perf_counter() - start) * 1000)
+
+    memory = ConversationMemory('user', exchanges[:10])
+    persistent = []
+    for exchange in exchanges[10:]:
+        start = time.perf_counter()
+        memory.get_context_summary()
+        memory.add_exchange(exchange['user_message'], exchange['bot_response'])
+        persistent.append((time.perf_counter() - start) * 1000)
+
+    print("Conversation memory per message (rebuilt from history vs live)")
+    for name, timings in [('rebuilt', rebuilt), ('live', persistent)]:
+        print(f"  {name}: p50 {percentile(timings, 50):.4f} ms | p99 {percentile(timings, 99):.4f} ms")
+
+
+def benchmark_chain(count: int):
+    """Compare building an LLMChain for every message with invoking the prebuilt pipeline"""
+    empathibot = Empathibot(db=None, llm=FakeListLLM(responses=["I'm here with you."]))
+    messages = synthetic_messages(count, 100, FILLER_WORDS['en'], AMBIGUOUS_PHRASES, 0.1, seed=4)
+    history = "User: long day\nAssistant: I'm sorry it was so long."
+
+    per_message = []
+    for message in messages:
+        start = time.perf_counter()
+        chain = LLMChain(llm=empathibot.llm, prompt=empathibot.prompt_template, verbose=False)
+        chain.predict(input=message, history=history)
+        per_message.append((time.perf_counter() - start) * 1000)
+
+    prebuilt = []
+    for message in messages:
+        start = time.perf_counter()
+        empathibot.conversation_chain.predict(input=message, history=history)
+        prebuilt.append((time.perf_counter() - start) * 1000)
+
+    print("LLM chain per message (built per message vs built once)")
+    for name, timings in [('per message', per_message), ('prebuilt', prebuilt)]:
+        print(f"  {name}: p50 {percentile(timings, 50):.4f} ms | p99 {percentile(timings, 99):.4f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Empathibot latency benchmarks")
+    parser.add_argument('--count', type=int, default=100, help="Messages per corpus")
+    parser.add_argument('--rounds', type=int, default=5, help="Timed rounds per corpus; the best is kept")
+    parser.add_argument('--lengths', type=int, nargs='+', default=LENGTHS)
+    parser.add_argument('--languages', nargs='+', default=LANGUAGES, choices=sorted(FILLER_WORDS))
+    parser.add_argument('--densities', type=float, nargs='+', default=HIT_DENSITIES)
+    parser.add_argument('--compare-ref', metavar='REF',
+                        help="Fail on regressions against this git ref, timed side by side on this machine")
+    parser.add_argument('--processes', type=int, default=5,
+                        help="Worker processes per tree for --compare-ref; each side reports their median")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="Baseline JSON file")
+    parser.add_argument('--save-baseline', action='store_true', help="Write results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help="Allowed slowdown against the baseline, as a fraction")
+    parser.add_argument('--max-fuzzy-p99-ms', type=float, default=5.0,
+                        help="Fail if any fuzzy crisis detection p99 is above this (the default fuzzy budget)")
+    parser.add_argument('--cascade', action='store_true', help="Also report classifier cascade stages")
+    parser.add_argument('--memory', action='store_true', help="Also compare conversation memory rebuilding")
+    parser.add_argument('--chain', action='store_true', help="Also compare per-message LLM chain construction")
+    parser.add_argument('--batch-sentiment', type=int, nargs='*', metavar='SIZE',
+                        help=f"Also compare batch sentiment scoring (default sizes {BATCH_SIZES})")
+    args = parser.parse_args()
+
+    print("Empathibot benchmarks")
+    failures = []
+    if args.compare_ref:
+        config = {'count': args.count, 'lengths': args.lengths, 'languages': args.languages,
+                  'densities': args.densities}
+        print(f"  timing {args.compare_ref} against the working tree, round by round")
+        baseline, results = compare_to_ref(args.compare_ref, config, args.rounds, args.processes)
+        failures += find_regressions(results, baseline, args.threshold)
+    else:
+        results = run_benchmarks(args.count, args.lengths, args.languages, args.densities, args.rounds)
+
+    if args.cascade:
+        benchmark_cascade(args.count, args.lengths)
+    if args.memory:
+        benchmark_conversation_memory(args.count)
+    if args.chain:
+        benchmark_chain(args.count)
+    if args.batch_sentiment is not None:
+        benchmark_batch_sentiment(args.batch_sentiment or BATCH_SIZES)
+
+    failures += [
+        f"{case} p99 {result['p99_ms']:.4f} ms is above the {args.max_fuzzy_p99_ms} ms fuzzy budget"
+        for case, result in results.items()
+        if case.startswith('detect_crisis_fuzzy') and result['p99_ms'] > args.max_fuzzy_p99_ms
+    ]
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print(f"✅ Baseline saved to {args.baseline}")
+    elif not args.compare_ref and os.path.exists(args.baseline):
+        # A baseline recorded at another time or on another machine is too noisy to gate on
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        for drift in find_regressions(results, baseline, args.threshold):
+            print(f"⚠️ Slower than the recorded baseline: {drift}")
+
+    if failures:
+        print("❌ Benchmark regressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+
+    print("✅ No benchmark regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,74 +8,969 @@ A comprehensive WhatsApp-based mental health support system with:
 - Automated wellness check-ins
 """
 
+import copy
 import os
 import re
+import hashlib
 import json
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+import unicodedata
+import zlib
+from bisect import bisect_right
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
 from langchain_community.llms import OpenAI
 from langchain.prompts import PromptTemplate
 from langchain.memory import ConversationBufferWindowMemory
 from langchain.chains import LLMChain
 import langdetect
+import numpy as np
 from firebase_admin import firestore
 
+from sentiment import NEGATION_WINDOW, NEGATION_WORDS, SentimentAnalyzer, tokenize
 
-class CrisisDetector:
-    """Advanced crisis detection system with severity scoring"""
+# langdetect is randomized; a fixed seed makes the same text always get the same language
+langdetect.DetectorFactory.seed = 0
 
-    def __init__(self):
-        # Critical crisis keywords (highest severity)
-        self.critical_keywords = [
-            'suicide', 'kill myself', 'end my life', 'want to die', 'better off dead',
-            'suicide plan', 'overdose', 'jump off', 'hang myself', 'shoot myself',
-            'cut myself', 'hurt myself badly', 'end it all', 'no reason to live',
-            'suicidio', 'quiero morir', 'me quiero morir', 'me quiero matar',
-            'je veux mourir', 'me suicider', 'je veux me tuer'
-        ]
 
-        # High severity keywords
-        self.high_severity_keywords = [
-            'self harm', 'cut', 'cutting', 'harm myself', 'hurt myself',
-            'hopeless', 'worthless', 'nothing matters', 'give up', 'can\'t go on',
-            'everyone would be better', 'burden to everyone', 'life is meaningless',
-            'autolesion', 'desesperado', 'sin esperanza', 'no puedo mas',
-            'sans espoir', 'je ne peux plus', 'tout est inutile'
-        ]
+class KeywordMatcher:
+    """
+    Lexicon compiled into a single regex that finds every keyword hit in one pass
 
-        # Moderate severity keywords
-        self.moderate_keywords = [
-            'depressed', 'anxious', 'panic attack', 'can\'t cope', 'overwhelmed',
-            'breaking down', 'losing it', 'can\'t handle', 'falling apart',
-            'hate myself', 'failure', 'disaster', 'terrible', 'awful day',
-            'deprimido', 'ansioso', 'ataque de panico', 'no puedo manejar',
-            'deprime', 'anxieux', 'attaque de panique', 'submerge'
-        ]
+    Tiered keywords match on word boundaries with any whitespace between their
+    words, exactly as if each keyword were searched on its own, so overlapping
+    hits such as "cut" inside "cut myself" are all reported. Positive keywords
+    are plain substring checks. The alternations are nested as character tries,
+    so a scan slows down only a little as keywords of more languages are added.
+    """
+
+    _boundary = re.compile(r"\b")
+
+    def __init__(self, keywords: List[str], positive_keywords: List[str]):
+        self.keywords = list(keywords)
+        self.positive_keywords = list(positive_keywords)
+
+        # First word of each keyword -> [(index, pattern for the other words)]
+        self._heads: Dict[str, List[Tuple[int, Optional[re.Pattern]]]] = {}
+        for index, keyword in enumerate(self.keywords):
+            parts = keyword.split()
+            if not parts:
+                continue
+            rest = None
+            if len(parts) > 1:
+                rest = re.compile(
+                    r"\s+" + r"\s+".join(re.escape(part) for part in parts[1:]) + r"\b"
+                )
+            self._heads.setdefault(parts[0], []).append((index, rest))
+
+        positives = sorted({keyword for keyword in self.positive_keywords if keyword})
+
+        # The regex only reports the longest head/positive starting at a position,
+        # so remember which shorter ones are prefixes of it and also match there.
+        self._head_prefixes = self._prefix_table(self._heads)
+        self._positive_prefixes = self._prefix_table(positives)
+
+        heads_alt = self._alternation(self._heads)
+        positives_alt = self._alternation(positives)
+        self._pattern = re.compile(
+            r"\b(?=(" + heads_alt + r")(?:\b|\s))(?=(" + positives_alt + r"))?"
+            r"|(?=(" + positives_alt + r"))"
+        )
+
+    @staticmethod
+    def _alternation(words) -> str:
+        """
+        Regex for any of the words, preferring the longest, nested as a character trie
+
+        re tries the branches of a flat alternation one by one at every
+        position; in a trie only the branch of the text's next letter is followed.
+        """
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        if not trie:
+            return "(?!)"
+        return KeywordMatcher._trie_pattern(trie)
+
+    @staticmethod
+    def _trie_pattern(node: Dict) -> str:
+        branches = [re.escape(char) + KeywordMatcher._trie_pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # A word that ends here is only tried once every longer one has failed
+        return f'(?:{pattern})?' if '' in node else pattern
+
+    @staticmethod
+    def _prefix_table(words) -> Dict[str, List[str]]:
+        return {
+            word: [other for other in words if word.startswith(other)]
+            for word in words
+        }
+
+    def scan(self, text_lower: str) -> Tuple[List[Tuple[int, int]], List[int]]:
+        """
+        Scan lowercased text once
 
-        # Positive/coping keywords (reduce severity)
-        self.positive_keywords = [
-            'better', 'improving', 'hopeful', 'trying', 'grateful', 'thankful',
-            'getting help', 'therapy', 'counselor', 'support', 'family', 'friends'
+        Returns:
+            Keyword hits as (keyword index, start) in lexicon order, and the
+            indexes of the positive keywords present in the text
+        """
+        hits = []
+        last_end = {}
+        positive_hits = set()
+
+        for match in self._pattern.finditer(text_lower):
+            start = match.start()
+            head = match.group(1)
+            positive = match.group(2) or match.group(3)
+
+            if head:
+                for prefix in self._head_prefixes[head]:
+                    after = start + len(prefix)
+                    for index, rest in self._heads[prefix]:
+                        # Same-keyword hits never overlap, as with re.finditer
+                        if start < last_end.get(index, 0):
+                            continue
+                        if rest is None:
+                            if not self._boundary.match(text_lower, after):
+                                continue
+                            end = after
+                        else:
+                            rest_match = rest.match(text_lower, after)
+                            if not rest_match:
+                                continue
+                            end = rest_match.end()
+                        last_end[index] = end
+                        hits.append((index, start))
+
+            if positive:
+                positive_hits.update(self._positive_prefixes[positive])
+
+        hits.sort()
+        positive_indexes = [
+            index for index, keyword in enumerate(self.positive_keywords)
+            if keyword in positive_hits
         ]
+        return hits, positive_indexes
+
+
+def _build_fuzzy_translation() -> Dict[int, str]:
+    """Fold accented Latin letters to ASCII and undo common leetspeak"""
+    table = {}
+    for code_point in range(0xC0, 0x250):
+        decomposed = unicodedata.normalize('NFKD', chr(code_point))
+        base = decomposed[0]
+        if len(decomposed) > 1 and base.isascii() and base.isalpha():
+            table[code_point] = base.lower()
+    table.update({ord(leet): letter for leet, letter in {
+        '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '@': 'a', '$': 's'
+    }.items()})
+    return table
+
+
+FUZZY_TRANSLATION = _build_fuzzy_translation()
+
+
+class FuzzyIndex:
+    """
+    Typo and obfuscation tolerant rewrite of a message onto lexicon words
+
+    Text is folded with a single str.translate pass (accents, leetspeak), slang
+    is expanded and words within one insertion, deletion or transposition of a
+    lexicon word are rewritten to it, using a SymSpell-style deletion dictionary
+    built once per lexicon. Substitutions, first-letter changes, short words and
+    plural or past tense endings are never corrected since they turn everyday
+    words into crisis terms ("homeless" -> "hopeless", "putting" -> "cutting",
+    "overdosed" -> "overdose", "cuttings" -> "cutting").
+    """
+
+    MIN_WORD_LENGTH = 5
+    # A lexicon word plus one of these is an inflection, not a typo ("suicides", "overdosed")
+    INFLECTION_ENDINGS = ('s', 'd')
+    CACHE_SIZE = 10000
+
+    SLANG = {
+        'wanna': 'want to',
+        'gonna': 'going to',
+        'gotta': 'got to',
+        'kms': 'kill myself',
+        'cant': "can't",
+        'cannot': "can't"
+    }
+
+    _word_pattern = re.compile(r"[^\W\d_]+")
+
+    def __init__(self, words: Iterable[str]):
+        self.words = {word for word in words if len(word) >= self.MIN_WORD_LENGTH}
+        self._deletes: Dict[str, set] = {}
+        for word in self.words:
+            for variant in self._deletions(word):
+                self._deletes.setdefault(variant, set()).add(word)
+        # A correction keeps the first letter, changes the length by at most one and
+        # keeps the last letter unless the edit is at the end. Words whose (first
+        # letter, length, last letter) fit no lexicon word are skipped without a lookup
+        self._shapes = set()
+        self._extended_shapes = set()  # an extra letter at the end: matched on the second to last
+        for word in self.words:
+            first, size = word[0], len(word)
+            self._shapes.update([
+                (first, size, word[-1]), (first, size, word[-2]),
+                (first, size + 1, word[-1]),
+                (first, size - 1, word[-1]), (first, size - 1, word[-2])
+            ])
+            self._extended_shapes.add((first, size + 1, word[-1]))
+        self._cache: Dict[str, Optional[str]] = {}
+
+    @staticmethod
+    def _deletions(word: str) -> set:
+        return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+    @staticmethod
+    def _is_transposition(word: str, candidate: str) -> bool:
+        diffs = [i for i in range(len(word)) if word[i] != candidate[i]]
+        return (
+            len(diffs) == 2 and diffs[1] == diffs[0] + 1
+            and word[diffs[0]] == candidate[diffs[1]]
+            and word[diffs[1]] == candidate[diffs[0]]
+        )
+
+    def _correct_word(self, word: str) -> Optional[str]:
+        if word in self._cache:
+            return self._cache[word]
+
+        correction = self.SLANG.get(word)
+        if correction is None and len(word) >= self.MIN_WORD_LENGTH and word not in self.words:
+            # Missing letter: the word is a deletion of a lexicon word
+            candidates = set(self._deletes.get(word, ()))
+            inflected = word[-1] in self.INFLECTION_ENDINGS
+            for variant in self._deletions(word):
+                # Extra letter: a deletion of the word is a lexicon word, unless it's an ending
+                if variant in self.words and not (inflected and variant == word[:-1]):
+                    candidates.add(variant)
+                # Transposition: same length and a shared deletion
+                for candidate in self._deletes.get(variant, ()):
+                    if len(candidate) == len(word) and self._is_transposition(word, candidate):
+                        candidates.add(candidate)
+            matches = [candidate for candidate in candidates if candidate[0] == word[0]]
+            correction = min(matches) if matches else None
+
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[word] = correction
+        return correction
+
+    def _may_correct(self, word: str) -> bool:
+        if word in self.SLANG:
+            return True
+        if len(word) < self.MIN_WORD_LENGTH:
+            return False
+        return ((word[0], len(word), word[-1]) in self._shapes
+                or (word[-1] not in self.INFLECTION_ENDINGS
+                    and (word[0], len(word), word[-2]) in self._extended_shapes))
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def correct(self, text_lower: str, budget_seconds: float) -> Tuple[str, List[Dict], bool]:
+        """
+        Rewrite lowercased text onto lexicon words
+
+        Each distinct word is checked once, in order of appearance. Words
+        reached after the time budget runs out are left as they are, so the
+        exact match still runs on the rest of the message.
+
+        Returns:
+            The rewritten text, the corrections that were applied and whether
+            the budget ran out before every word was checked
+        """
+        deadline = time.perf_counter() + budget_seconds
+        folded = text_lower.translate(FUZZY_TRANSLATION)
+        replacements = {}
+        exhausted = False
+        for word in dict.fromkeys(self._word_pattern.findall(folded)):
+            if not self._may_correct(word):
+                continue
+            if time.perf_counter() > deadline:
+                exhausted = True
+                break
+            correction = self._correct_word(word)
+            if correction is not None:
+                replacements[word] = correction
+        if not replacements:
+            return folded, [], exhausted
+
+        corrections = []
+
+        def replace(match):
+            word = match.group(0)
+            correction = replacements.get(word)
+            if correction is None:
+                return word
+            corrections.append({'original': word, 'corrected': correction})
+            return correction
+
+        return self._word_pattern.sub(replace, folded), corrections, exhausted
+
+
+class CrisisLexicon:
+    """
+    Versioned crisis keyword lexicon, compiled into a KeywordMatcher
 
-        self.negation_words = {
-            'not', "don't", 'dont', 'never', 'no', 'without', "isn't", 'isnt',
-            "can't", 'cant', "won't", 'wont', "didn't", 'didnt', "doesn't", 'doesnt',
-            "wasn't", 'wasnt', "aren't", 'arent'
+    Each entry has a keyword, a tier (critical, high, moderate or positive),
+    a weight added to the severity score per hit and a language code. Every
+    message is scanned for every language's keywords, so a misdetected
+    language never hides a crisis phrase.
+    """
+
+    TIERS = ('critical', 'high', 'moderate', 'positive')
+    DEFAULT_WEIGHTS = {'critical': 100, 'high': 50, 'moderate': 20, 'positive': -10}
+
+    def __init__(self, entries: List[Dict], version: str):
+        self.version = version
+        self.entries = [self._normalize_entry(entry) for entry in entries]
+
+        # Tiered keywords are reported critical first, then high, then moderate
+        tier_rank = {tier: rank for rank, tier in enumerate(self.TIERS)}
+        self.keywords = sorted(
+            (entry for entry in self.entries if entry['tier'] != 'positive'),
+            key=lambda entry: tier_rank[entry['tier']]
+        )
+        self.positive_keywords = [entry for entry in self.entries if entry['tier'] == 'positive']
+
+        self.matcher = KeywordMatcher(
+            [entry['keyword'] for entry in self.keywords],
+            [entry['keyword'] for entry in self.positive_keywords]
+        )
+        self.fuzzy_index = FuzzyIndex(
+            word
+            for entry in self.entries if entry['tier'] != 'positive'
+            for word in entry['keyword'].split()
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'CrisisLexicon':
+        """Load and compile a lexicon from a JSON file"""
+        with open(path, encoding='utf-8') as lexicon_file:
+            data = json.load(lexicon_file)
+        return cls(data['keywords'], str(data['version']))
+
+    def _normalize_entry(self, entry: Dict) -> Dict:
+        keyword = str(entry.get('keyword', '')).lower()
+        tier = entry.get('tier')
+        if not keyword.strip():
+            raise ValueError("Crisis lexicon entries need a non-empty keyword")
+        if tier not in self.TIERS:
+            raise ValueError(f"Unknown crisis lexicon tier '{tier}' for keyword '{keyword}'")
+        return {
+            'keyword': keyword,
+            'tier': tier,
+            'weight': entry.get('weight', self.DEFAULT_WEIGHTS[tier]),
+            'language': entry.get('language', 'en')
+        }
+
+    def keywords_for(self, tier: str) -> List[str]:
+        """Get the keywords of one tier in lexicon order"""
+        return [entry['keyword'] for entry in self.entries if entry['tier'] == tier]
+
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of a list of samples"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class LatencyTracker:
+    """Rolling latency samples for one processing stage"""
+
+    def __init__(self, max_samples: int = 1000):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+
+    def record(self, elapsed_ms: float):
+        self.samples.append(elapsed_ms)
+        self.count += 1
+
+    def summary(self) -> Dict:
+        """Get the call count and recent p50/p99 latency in milliseconds"""
+        samples = list(self.samples)
+        return {
+            'count': self.count,
+            'p50_ms': percentile(samples, 50),
+            'p99_ms': percentile(samples, 99)
         }
 
-    def _keyword_pattern(self, keyword: str) -> re.Pattern:
-        parts = [re.escape(part) for part in keyword.split()]
-        pattern = r"\b" + r"\s+".join(parts) + r"\b"
-        return re.compile(pattern)
 
-    def _is_negated(self, text_lower: str, match_start: int) -> bool:
-        words = [
-            (match.group(0), match.start(), match.end())
-            for match in re.finditer(r"[a-z']+", text_lower)
+class ResultCache:
+    """
+    Bounded LRU cache of analysis results for repeated messages
+
+    Keys are a hash of the normalized text plus whatever else the result
+    depends on (language, lexicon version). Results are copied in and out so
+    callers can annotate them and extend their lists freely.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _copy(result: Dict) -> Dict:
+        return {key: list(value) if isinstance(value, list) else value for key, value in result.items()}
+
+    @staticmethod
+    def make_key(text_normalized: str, *parts) -> Tuple:
+        digest = hashlib.blake2b(text_normalized.encode('utf-8'), digest_size=16).digest()
+        return (digest,) + parts
+
+    def get(self, key: Tuple) -> Optional[Dict]:
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return self._copy(result)
+
+    def put(self, key: Tuple, result: Dict):
+        if self.max_size <= 0:
+            return
+        result = self._copy(result)
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """Get size and hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else None
+            }
+
+
+class ProfileCache:
+    """
+    Bounded LRU cache of user profiles that expire after a TTL
+
+    Entries are keyed by user ID, with their phone number indexed so a user can
+    be found without a Firestore read. Writes made by this process are applied
+    to the cached profile (write-through); the TTL bounds how stale a profile can
+    get from writes made elsewhere, e.g. by other gunicorn workers. Fields that
+    are read, changed and written back must not come from here, see
+    UserSessionManager.get_user(fresh=True).
+    """
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 300.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # user ID -> (expires at, profile)
+        self._phone_ids = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _pop(self, user_id: str) -> Optional[Dict]:
+        _, profile = self._entries.pop(user_id)
+        phone_number = profile.get('phone_number')
+        if self._phone_ids.get(phone_number) == user_id:
+            del self._phone_ids[phone_number]
+        return profile
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._pop(user_id)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def get_by_phone(self, phone_number: str) -> Optional[Dict]:
+        with self._lock:
+            user_id = self._phone_ids.get(phone_number)
+        if user_id is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return self.get(user_id)
+
+    def user_id_for_phone(self, phone_number: str) -> Optional[str]:
+        """ID of a cached user by phone number, without copying the profile or counting a lookup"""
+        with self._lock:
+            return self._phone_ids.get(phone_number)
+
+    def put(self, user_id: str, profile: Dict):
+        if self.max_size <= 0:
+            return
+        profile = copy.deepcopy(profile)
+        with self._lock:
+            if user_id in self._entries:
+                self._pop(user_id)
+            self._entries[user_id] = (time.monotonic() + self.ttl_seconds, profile)
+            if profile.get('phone_number'):
+                self._phone_ids[profile['phone_number']] = user_id
+            while len(self._entries) > self.max_size:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def update(self, user_id: str, fields: Dict):
+        """
+        Apply Firestore-style field updates to a cached profile
+
+        Understands dotted paths, Increment, SERVER_TIMESTAMP and DELETE_FIELD.
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            for path, value in fields.items():
+                *parents, name = path.split('.')
+                target = entry[1]
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                if isinstance(value, firestore.Increment):
+                    target[name] = (target.get(name) or 0) + value._value
+                elif value is firestore.SERVER_TIMESTAMP:
+                    target[name] = datetime.now(timezone.utc)
+                elif value is firestore.DELETE_FIELD:
+                    target.pop(name, None)
+                else:
+                    target[name] = copy.deepcopy(value)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            if user_id in self._entries:
+                self._pop(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._phone_ids.clear()
+
+    def stats(self) -> Dict:
+        """Get size and hit/miss/eviction/expiration counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else None
+            }
+
+
+class ConversationWindowCache:
+    """
+    Most recent messages per user, so building conversation context needs no query
+
+    Seeded from Firestore on a miss and appended to as messages are saved.
+    Memory is bounded by an LRU over users and a cap on the UTF-8 bytes of
+    message text kept per user, dropping a user's oldest messages first.
+    Entries expire after a TTL, like cached profiles, so messages handled by
+    another process are picked up.
+    """
+
+    def __init__(self, max_users: int = 10000, max_bytes_per_user: int = 16384,
+                 window: int = 10, ttl_seconds: float = 300.0):
+        self.max_users = max_users
+        self.max_bytes_per_user = max_bytes_per_user
+        self.window = window
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # user ID -> {'expires_at', 'messages', 'bytes'}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(message: Dict) -> int:
+        return (len((message.get('user_message') or '').encode('utf-8'))
+                + len((message.get('bot_response') or '').encode('utf-8')))
+
+    def _add(self, entry: Dict, message: Dict):
+        entry['messages'].append((self._size(message), message))
+        entry['bytes'] += entry['messages'][-1][0]
+        while entry['messages'] and (len(entry['messages']) > self.window
+                                     or entry['bytes'] > self.max_bytes_per_user):
+            entry['bytes'] -= entry['messages'].popleft()[0]
+
+    def get(self, user_id: str, limit: int) -> Optional[List[Dict]]:
+        """The user's last `limit` messages, oldest first, or None if they must be read from Firestore"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry['expires_at'] <= time.monotonic():
+                del self._entries[user_id]
+                entry = None
+            if entry is None or limit > self.window:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return [dict(message) for _, message in list(entry['messages'])[-limit:]]
+
+    def seed(self, user_id: str, messages: List[Dict]):
+        """Cache a user's recent messages as read from Firestore, oldest first"""
+        if self.max_users <= 0:
+            return
+        entry = {'expires_at': time.monotonic() + self.ttl_seconds, 'messages': deque(), 'bytes': 0}
+        for message in messages[-self.window:]:
+            self._add(entry, dict(message))
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def append(self, user_id: str, message: Dict):
+        """Add a saved message to a cached user's window; uncached users are seeded on their next read"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._add(entry, dict(message))
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict:
+        """Get user count, cached bytes and hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self._entries),
+                'max_users': self.max_users,
+                'bytes': sum(entry['bytes'] for entry in self._entries.values()),
+                'max_bytes_per_user': self.max_bytes_per_user,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else None
+            }
+
+
+class RetrievalMemory:
+    """
+    Per-user index of stored exchanges for finding ones relevant to a new message
+
+    Each exchange is a hashed bag of the words of the user's message (sublinear
+    term frequency, unit length), stored sparsely. Search scores all of a
+    user's exchanges with one NumPy pass, so the score is their cosine
+    similarity. Users are kept in an LRU with a TTL and hold at most
+    max_entries exchanges, like the stored history.
+    """
+
+    _token_pattern = re.compile(r"[^\W_]+")
+
+    def __init__(self, max_users: int = 1000, max_entries: int = 50, n_features: int = 4096,
+                 ttl_seconds: float = 300.0):
+        self.max_users = max_users
+        self.max_entries = max_entries
+        self.n_features = n_features
+        self.ttl_seconds = ttl_seconds
+        self._indexes = OrderedDict()  # user ID -> {'expires_at', 'entries': deque of (ids, weights, exchange)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def vectorize(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Sparse unit vector of a text: hashed word ids and their weights"""
+        # Words of one or two letters carry little topic and would match everything
+        words = [word for word in self._token_pattern.findall(text.lower()) if len(word) > 2]
+        # crc32 rather than hash() so ids are stable across processes
+        counts = Counter(zlib.crc32(word.encode('utf-8')) % self.n_features for word in words)
+        ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        weights = 1 + np.log(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+        norm = np.sqrt(np.dot(weights, weights))
+        return ids, weights / norm if norm else weights
+
+    def _entry(self, message: Dict) -> Tuple[np.ndarray, np.ndarray, Dict]:
+        ids, weights = self.vectorize(message.get('user_message') or '')
+        exchange = {'user_message': message.get('user_message', ''), 'bot_response': message.get('bot_response', '')}
+        return ids, weights, exchange
+
+    def _live(self, user_id: str) -> Optional[Dict]:
+        index = self._indexes.get(user_id)
+        if index is not None and index['expires_at'] <= time.monotonic():
+            del self._indexes[user_id]
+            index = None
+        return index
+
+    def seed(self, user_id: str, messages: List[Dict]):
+        """Index a user's stored messages, oldest first"""
+        if self.max_users <= 0:
+            return
+        entries = deque((self._entry(message) for message in messages[-self.max_entries:]),
+                        maxlen=self.max_entries)
+        with self._lock:
+            self._indexes[user_id] = {'expires_at': time.monotonic() + self.ttl_seconds, 'entries': entries}
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+                self.evictions += 1
+
+    def add(self, user_id: str, message: Dict):
+        """Index a newly saved message; users without an index are seeded on their next search"""
+        entry = self._entry(message)
+        with self._lock:
+            index = self._live(user_id)
+            if index is not None:
+                index['entries'].append(entry)
+
+    def search(self, user_id: str, text: str, top_k: int, exclude_recent: int = 0,
+               min_score: float = 0.1) -> Optional[List[Tuple[float, Dict]]]:
+        """
+        The user's top_k exchanges most similar to a text, best first
+
+        Args:
+            exclude_recent: Number of newest exchanges to leave out, e.g. those already in the prompt
+            min_score: Lowest cosine similarity worth returning
+
+        Returns:
+            (score, exchange) pairs, or None if the user has no index yet
+        """
+        with self._lock:
+            index = self._live(user_id)
+            if index is None:
+                self.misses += 1
+                return None
+            self._indexes.move_to_end(user_id)
+            self.hits += 1
+            entries = list(index['entries'])
+        if exclude_recent:
+            entries = entries[:-exclude_recent]
+        if not entries or top_k <= 0:
+            return []
+
+        query_ids, query_weights = self.vectorize(text)
+        query = np.zeros(self.n_features)
+        query[query_ids] = query_weights
+        ids = np.concatenate([entry[0] for entry in entries])
+        weights = np.concatenate([entry[1] for entry in entries])
+        rows = np.repeat(np.arange(len(entries)), [len(entry[0]) for entry in entries])
+        scores = np.bincount(rows, weights=weights * query[ids], minlength=len(entries))
+
+        best = np.argsort(-scores, kind='stable')[:top_k]
+        return [(float(scores[i]), dict(entries[i][2])) for i in best if scores[i] >= min_score]
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._indexes.pop(user_id, None)
+
+    def stats(self) -> Dict:
+        """Get indexed users and exchanges and hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self._indexes),
+                'entries': sum(len(index['entries']) for index in self._indexes.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else None
+            }
+
+
+class CrisisClassifier:
+    """
+    Small CPU-only logistic regression over hashed word n-grams
+
+    Used as a second opinion on messages the lexicon scores as ambiguous.
+    Weights are trained offline with ``train`` and stored in a local .npz file.
+    """
+
+    _token_pattern = re.compile(r"[^\W_]+")
+
+    def __init__(self, weights: np.ndarray, bias: float, ngram_range: Tuple[int, int] = (1, 2)):
+        self.weights = weights
+        self.bias = bias
+        self.n_features = len(weights)
+        self.ngram_range = ngram_range
+
+    @classmethod
+    def load(cls, path: str) -> 'CrisisClassifier':
+        """Load classifier weights from a .npz file"""
+        with np.load(path) as data:
+            return cls(data['weights'], float(data['bias']), tuple(int(n) for n in data['ngram_range']))
+
+    def save(self, path: str):
+        """Save classifier weights to a .npz file"""
+        np.savez(path, weights=self.weights, bias=self.bias, ngram_range=np.array(self.ngram_range))
+
+    def _features(self, text_lower: str) -> np.ndarray:
+        tokens = self._token_pattern.findall(text_lower)
+        low, high = self.ngram_range
+        grams = [
+            ' '.join(tokens[i:i + n])
+            for n in range(low, high + 1)
+            for i in range(len(tokens) - n + 1)
         ]
-        preceding_words = [word for word, _, end in words if end <= match_start]
-        window = preceding_words[-3:]
+        # crc32 rather than hash() so feature ids are stable across processes
+        return np.fromiter(
+            (zlib.crc32(gram.encode('utf-8')) % self.n_features for gram in grams),
+            dtype=np.int64, count=len(grams)
+        )
+
+    def predict(self, text_lower: str) -> float:
+        """Probability that a lowercased message is a crisis"""
+        z = self.bias + self.weights[self._features(text_lower)].sum()
+        return float(1 / (1 + np.exp(-z)))
+
+    @classmethod
+    def train(cls, texts: List[str], labels: List[int], n_features: int = 2 ** 18,
+              ngram_range: Tuple[int, int] = (1, 2), epochs: int = 200,
+              learning_rate: float = 0.5, l2: float = 1e-4) -> 'CrisisClassifier':
+        """Fit weights with full-batch gradient descent on labeled messages"""
+        model = cls(np.zeros(n_features), 0.0, ngram_range)
+        rows = [model._features(text.lower()) for text in texts]
+        row_ids = np.repeat(np.arange(len(rows)), [len(row) for row in rows])
+        indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        y = np.asarray(labels, dtype=float)
+
+        for _ in range(epochs):
+            z = model.bias + np.bincount(row_ids, weights=model.weights[indices], minlength=len(rows))
+            error = 1 / (1 + np.exp(-z)) - y
+            gradient = np.bincount(indices, weights=error[row_ids], minlength=n_features) / len(rows)
+            model.weights -= learning_rate * (gradient + l2 * model.weights)
+            model.bias -= learning_rate * error.mean()
+
+        return model
+
+
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crisis_lexicon.json')
+
+
+class CrisisDetector:
+    """Advanced crisis detection system with severity scoring"""
+
+    def __init__(self, lexicon_path: Optional[str] = None, fuzzy: Optional[bool] = None,
+                 fuzzy_budget_ms: float = 5.0, classifier_path: Optional[str] = None,
+                 model_band: Tuple[int, int] = (20, 50), model_threshold: float = 0.5,
+                 cache_size: Optional[int] = None):
+        # Keyword lexicon is loaded from a versioned file so it can be hot-reloaded
+        self.lexicon_path = lexicon_path or os.getenv('CRISIS_LEXICON_PATH', DEFAULT_LEXICON_PATH)
+        self._lexicon_mtime = os.path.getmtime(self.lexicon_path)
+        self.lexicon = CrisisLexicon.load(self.lexicon_path)
+        self._watcher_stop = None
+
+        # Fuzzy mode also catches typos, leetspeak, accents and slang within a time budget
+        if fuzzy is None:
+            fuzzy = os.getenv('CRISIS_FUZZY_MATCHING', 'false').lower() in {'1', 'true', 'yes'}
+        self.fuzzy = fuzzy
+        self.fuzzy_budget_ms = fuzzy_budget_ms
+
+        # Optional second stage, only consulted for lexicon scores inside model_band
+        classifier_path = classifier_path or os.getenv('CRISIS_CLASSIFIER_PATH')
+        self.classifier = CrisisClassifier.load(classifier_path) if classifier_path else None
+        self.model_band = model_band
+        self.model_threshold = model_threshold
+        self.latency = {'lexicon': LatencyTracker(), 'classifier': LatencyTracker()}
+
+        # Short messages like "ok" and "thanks" repeat a lot, so results are memoized
+        if cache_size is None:
+            cache_size = int(os.getenv('CRISIS_CACHE_SIZE', '10000'))
+        self.cache = ResultCache(cache_size)
+
+        self.negation_words = NEGATION_WORDS
+
+    def __getstate__(self):
+        # The watcher thread stays with the process that started it
+        state = self.__dict__.copy()
+        state['_watcher_stop'] = None
+        state['cache'] = ResultCache(self.cache.max_size)
+        return state
+
+    def reload_lexicon(self) -> bool:
+        """
+        Load the lexicon file again and swap it in if its version changed
+
+        The new matcher is compiled before the swap, and messages already being
+        scored keep the lexicon they started with.
+
+        Returns:
+            bool: True if a new version was swapped in
+        """
+        lexicon = CrisisLexicon.load(self.lexicon_path)
+        if lexicon.version == self.lexicon.version:
+            return False
+
+        self.lexicon = lexicon
+        # Entries keyed by the old version can never hit again
+        self.cache.clear()
+        print(f"🔄 Crisis lexicon reloaded: version {lexicon.version}")
+        return True
+
+    def start_lexicon_watcher(self, interval_seconds: float = 60) -> threading.Thread:
+        """Reload the lexicon in a background thread whenever its file changes"""
+        self.stop_lexicon_watcher()
+        stop = threading.Event()
+
+        def watch_lexicon():
+            while not stop.wait(interval_seconds):
+                try:
+                    mtime = os.path.getmtime(self.lexicon_path)
+                    if mtime != self._lexicon_mtime:
+                        self._lexicon_mtime = mtime
+                        self.reload_lexicon()
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    print(f"⚠️ Crisis lexicon reload failed, keeping version {self.lexicon.version}: {e}")
+
+        watcher_thread = threading.Thread(target=watch_lexicon, daemon=True)
+        watcher_thread.start()
+        self._watcher_stop = stop
+
+        return watcher_thread
+
+    def stop_lexicon_watcher(self):
+        """Stop the background lexicon watcher if one is running"""
+        if self._watcher_stop:
+            self._watcher_stop.set()
+            self._watcher_stop = None
+
+    def _is_negated(self, token_index: Tuple[List[str], List[int]], match_start: int) -> bool:
+        words, ends = token_index
+        preceding_count = bisect_right(ends, match_start)
+        window = words[max(0, preceding_count - NEGATION_WINDOW):preceding_count]
         return any(word in self.negation_words for word in window)
 
     def detect_crisis(self, text: str) -> Dict:
@@ -86,37 +981,96 @@ class CrisisDetector:
             Dict with 'is_crisis', 'severity', 'matched_keywords', 'confidence'
         """
         text_lower = text.lower()
+        key = ResultCache.make_key(text_lower, self.lexicon.version)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._score(text_lower)
+            # A reload during scoring means the result belongs to the new version's key
+            self.cache.put(ResultCache.make_key(text_lower, result['lexicon_version']), result)
+        return result
+
+    def detect_crisis_many(self, texts: Iterable[str], processes: Optional[int] = None,
+                           chunk_size: int = 1000) -> List[Dict]:
+        """
+        Score a batch of messages, e.g. when re-scoring exported history
+
+        Args:
+            texts: Messages to score
+            processes: Worker processes to spread the batch across (in-process if not set)
+            chunk_size: Number of messages sent to a worker at a time
+
+        Returns:
+            List of the same dicts as detect_crisis, in input order
+        """
+        texts = [text.lower() for text in texts]
+        # Stored history repeats a lot ("ok", "thanks"), so each distinct message is scored once
+        unique = list(dict.fromkeys(texts))
+        if not processes or processes <= 1 or len(unique) <= chunk_size:
+            scored = [self._score(text, record_latency=False) for text in unique]
+        else:
+            chunks = [unique[i:i + chunk_size] for i in range(0, len(unique), chunk_size)]
+            scored = []
+            # Each worker receives the compiled detector once, not once per chunk
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_batch_worker,
+                                     initargs=(self,)) as pool:
+                for chunk_results in pool.map(_detect_crisis_chunk, chunks):
+                    scored.extend(chunk_results)
+
+        results = dict(zip(unique, scored))
+        return [ResultCache._copy(results[text]) for text in texts]
+
+    def get_latency_stats(self) -> Dict:
+        """Get per-stage latency of the crisis detection cascade"""
+        return {stage: tracker.summary() for stage, tracker in self.latency.items()}
+
+    def get_cache_stats(self) -> Dict:
+        """Get hit/miss/eviction counters of the result cache"""
+        return self.cache.stats()
+
+    def warm_up(self):
+        """Run the compiled matcher and the fuzzy index once, outside the request path"""
+        lexicon = self.lexicon
+        lexicon.matcher.scan("warm up")
+        lexicon.fuzzy_index.correct("warm up", self.fuzzy_budget_ms / 1000)
+
+    def _score(self, text_lower: str, record_latency: bool = True) -> Dict:
+        # Batch scoring passes record_latency=False so backfills don't skew the live latency stats
+        started = time.perf_counter()
+        # Use one lexicon for the whole message even if a reload swaps it meanwhile
+        lexicon = self.lexicon
         severity_score = 0
         matched_keywords = []
+        fuzzy_corrections = []
+        fuzzy_budget_exhausted = False
+
+        if self.fuzzy:
+            text_lower, fuzzy_corrections, fuzzy_budget_exhausted = lexicon.fuzzy_index.correct(
+                text_lower, self.fuzzy_budget_ms / 1000
+            )
+
+        hits, positive_hits = lexicon.matcher.scan(text_lower)
+        token_index = tokenize(text_lower) if hits else ([], [])
 
-        # Check critical keywords (score: 100 each)
-        for keyword in self.critical_keywords:
-            pattern = self._keyword_pattern(keyword)
-            for match in pattern.finditer(text_lower):
-                if not self._is_negated(text_lower, match.start()):
-                    severity_score += 100
-                    matched_keywords.append(keyword)
-
-        # Check high severity keywords (score: 50 each)
-        for keyword in self.high_severity_keywords:
-            pattern = self._keyword_pattern(keyword)
-            for match in pattern.finditer(text_lower):
-                if not self._is_negated(text_lower, match.start()):
-                    severity_score += 50
-                    matched_keywords.append(keyword)
-
-        # Check moderate keywords (score: 20 each)
-        for keyword in self.moderate_keywords:
-            pattern = self._keyword_pattern(keyword)
-            for match in pattern.finditer(text_lower):
-                if not self._is_negated(text_lower, match.start()):
-                    severity_score += 20
-                    matched_keywords.append(keyword)
-
-        # Reduce score for positive keywords (score: -10 each)
-        for keyword in self.positive_keywords:
-            if keyword in text_lower:
-                severity_score = max(0, severity_score - 10)
+        # Add the weight of every keyword that isn't negated (critical 100, high 50, moderate 20)
+        for index, start in hits:
+            if not self._is_negated(token_index, start):
+                entry = lexicon.keywords[index]
+                severity_score += entry['weight']
+                matched_keywords.append(entry['keyword'])
+
+        # Reduce score for positive keywords (-10 each)
+        for index in positive_hits:
+            severity_score = max(0, severity_score + lexicon.positive_keywords[index]['weight'])
+
+        lexicon_done = time.perf_counter()
+        if record_latency:
+            self.latency['lexicon'].record((lexicon_done - started) * 1000)
+
+        model_score = None
+        if self.classifier and self.model_band[0] <= severity_score < self.model_band[1]:
+            model_score = self.classifier.predict(text_lower)
+            if record_latency:
+                self.latency['classifier'].record((time.perf_counter() - lexicon_done) * 1000)
 
         # Determine severity level
         if severity_score >= 100:
@@ -132,6 +1086,11 @@ class CrisisDetector:
             severity = "low"
             is_crisis = False
 
+        # The classifier can escalate an ambiguous message but never downgrade one
+        if model_score is not None and model_score >= self.model_threshold and not is_crisis:
+            severity = "high"
+            is_crisis = True
+
         # Calculate confidence based on number and type of matches
         confidence = min(1.0, len(matched_keywords) * 0.2)
 
@@ -139,8 +1098,12 @@ class CrisisDetector:
             "is_crisis": is_crisis,
             "severity": severity,
             "severity_score": severity_score,
+            "model_score": model_score,
             "matched_keywords": matched_keywords,
-            "confidence": confidence
+            "confidence": confidence,
+            "lexicon_version": lexicon.version,
+            "fuzzy_corrections": fuzzy_corrections,
+            "fuzzy_budget_exhausted": fuzzy_budget_exhausted
         }
 
     def get_crisis_response(self, severity: str) -> str:
@@ -195,10 +1158,89 @@ I'm here to listen. Would you like to talk about what's troubling you?"""
             return None
 
 
+_batch_detector: Optional[CrisisDetector] = None
+
+
+def _init_batch_worker(detector: CrisisDetector):
+    global _batch_detector
+    _batch_detector = detector
+
+
+def _detect_crisis_chunk(texts_lower: List[str]) -> List[Dict]:
+    return [_batch_detector._score(text, record_latency=False) for text in texts_lower]
+
+
+class RollingRiskTracker:
+    """
+    Conversation-level crisis risk that decays over time
+
+    Each message adds its severity score to the previous score, halved once
+    per half-life since the last message, so risk building up over several
+    messages is caught without rescanning history. The state is a small dict
+    stored on the user document.
+    """
+
+    def __init__(self, threshold: Optional[float] = None, half_life_hours: Optional[float] = None):
+        self.threshold = threshold if threshold is not None else float(
+            os.getenv('ROLLING_RISK_THRESHOLD', '90'))
+        self.half_life_hours = half_life_hours if half_life_hours is not None else float(
+            os.getenv('ROLLING_RISK_HALF_LIFE_HOURS', '6'))
+
+    def update(self, state: Optional[Dict], severity_score: float, now: Optional[float] = None) -> Dict:
+        """Fold one message's severity score into the previous state"""
+        now = time.time() if now is None else now
+        score = 0.0
+        if state:
+            elapsed_hours = max(0.0, now - state['updated_at']) / 3600
+            score = state['score'] * 0.5 ** (elapsed_hours / self.half_life_hours)
+        return {'score': score + severity_score, 'updated_at': now}
+
+    def is_escalated(self, state: Dict) -> bool:
+        return state['score'] >= self.threshold
+
+    def reset(self, now: Optional[float] = None) -> Dict:
+        """State after a crisis response has been sent"""
+        return {'score': 0.0, 'updated_at': time.time() if now is None else now}
+
+
 class LanguageHandler:
-    """Multilingual support with automatic language detection"""
+    """
+    Multilingual support with automatic language detection
+
+    Detection is tiered from cheapest to most expensive:
+    - script: letters are mostly Arabic, Devanagari, kana or CJK
+    - short: too short to detect reliably, so the user's preferred language is kept
+    - langdetect: ambiguous Latin-script text
+    - fallback: langdetect failed or found an unsupported language
+
+    detect_for_user() adds a 'sticky' tier on top: a per-user running language
+    distribution that skips detection once it is confident.
+    """
+
+    # Letters of a non-Latin script and the language they decide
+    SCRIPT_PATTERNS = [
+        ('ja', re.compile(r'[\u3040-\u30ff]')),
+        ('zh-cn', re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff]')),
+        ('ar', re.compile(r'[\u0600-\u06ff\u0750-\u077f\u08a0-\u08ff\ufb50-\ufdff\ufe70-\ufeff]')),
+        ('hi', re.compile(r'[\u0900-\u097f]'))
+    ]
+    LETTER_PATTERN = re.compile(r'[^\W\d_]')
+
+    # Smallest weight a new detection gets in the running distribution, so a real switch still wins
+    MIN_UPDATE_WEIGHT = 0.1
+
+    def __init__(self, short_message_chars: Optional[int] = None, sticky_confidence: Optional[float] = None,
+                 recheck_every: Optional[int] = None, sticky_min_messages: int = 3):
+        if short_message_chars is None:
+            short_message_chars = int(os.getenv('LANGUAGE_SHORT_MESSAGE_CHARS', '20'))
+        self.short_message_chars = short_message_chars
+        self.sticky_confidence = sticky_confidence if sticky_confidence is not None else float(
+            os.getenv('LANGUAGE_STICKY_CONFIDENCE', '0.8'))
+        self.recheck_every = recheck_every if recheck_every is not None else int(
+            os.getenv('LANGUAGE_RECHECK_EVERY', '10'))
+        self.sticky_min_messages = sticky_min_messages
+        self.tier_counts = Counter()
 
-    def __init__(self):
         self.supported_languages = {
             'en': 'English',
             'es': 'Spanish',
@@ -221,75 +1263,358 @@ class LanguageHandler:
             'pt': "Linha Nacional de Prevenção ao Suicídio: 988 | Linha de Crise por Texto: Envie CASA para 741741"
         }
 
-    def detect_language(self, text: str) -> str:
+    def detect_language(self, text: str, preferred_language: Optional[str] = None) -> str:
         """Detect language of the input text"""
+        return self.detect(text, preferred_language)['language']
+
+    def detect(self, text: str, preferred_language: Optional[str] = None) -> Dict:
+        """
+        Detect language of the input text with the cheapest tier that can decide it
+
+        Args:
+            text: Message to detect
+            preferred_language: User's stored language, kept for short messages
+
+        Returns:
+            Dict with 'language' and the 'tier' that decided it
+        """
+        language, tier, _ = self._detect_tiers(text, self.LETTER_PATTERN.findall(text), preferred_language)
+        self.tier_counts[tier] += 1
+        return {'language': language, 'tier': tier}
+
+    def detect_for_user(self, text: str, profile: Optional[Dict],
+                        preferred_language: Optional[str] = None) -> Tuple[Dict, Dict]:
+        """
+        Detect language against the user's running language distribution
+
+        Each detection is folded into the distribution and the most likely
+        language is returned, so one misdetected message doesn't flip it. Once
+        a language holds `sticky_confidence` of the distribution, detection is
+        skipped except every `recheck_every` messages or when the script changes.
+
+        Args:
+            text: Message to detect
+            profile: Language profile stored on the user document, if any
+            preferred_language: User's stored language, kept for short messages
+
+        Returns:
+            Tuple of the same dict as detect() and the updated profile to store
+        """
+        if profile:
+            profile = dict(profile)
+        else:
+            profile = {'distribution': {}, 'messages': 0, 'since_check': 0, 'script': None}
+        letters = self.LETTER_PATTERN.findall(text)
+        script = self._detect_script(letters) or ('latin' if letters else None)
+        distribution = profile['distribution']
+        top = max(distribution, key=distribution.get) if distribution else None
+        script_changed = script is not None and profile['script'] is not None and script != profile['script']
+
+        if (top and distribution[top] >= self.sticky_confidence
+                and profile['messages'] >= self.sticky_min_messages
+                and profile['since_check'] < self.recheck_every and not script_changed):
+            profile['since_check'] += 1
+            self.tier_counts['sticky'] += 1
+            return {'language': top, 'tier': 'sticky'}, profile
+
+        language, tier, probabilities = self._detect_tiers(text, letters, top or preferred_language)
+        self.tier_counts[tier] += 1
+        if probabilities:
+            if script_changed:
+                distribution = {}
+                profile['messages'] = 0
+            weight = max(1 / (profile['messages'] + 1), self.MIN_UPDATE_WEIGHT)
+            merged = {lang: prob * (1 - weight) for lang, prob in distribution.items()}
+            for lang, prob in probabilities.items():
+                merged[lang] = merged.get(lang, 0.0) + prob * weight
+            profile['distribution'] = {lang: round(prob, 4) for lang, prob in merged.items() if prob >= 0.01}
+            profile['messages'] += 1
+            profile['since_check'] = 0
+            profile['script'] = script
+            language = max(profile['distribution'], key=profile['distribution'].get)
+
+        return {'language': language, 'tier': tier}, profile
+
+    def _detect_tiers(self, text: str, letters: List[str],
+                      preferred_language: Optional[str]) -> Tuple[str, str, Dict[str, float]]:
+        """Language, the tier that decided it, and its probabilities (empty when it was a fallback)"""
+        fallback = preferred_language if preferred_language in self.supported_languages else 'en'
+
+        language = self._detect_script(letters)
+        if language:
+            return language, 'script', {language: 1.0}
+        if len(text.strip()) < self.short_message_chars or not letters:
+            return fallback, 'short', {}
+
         try:
-            detected = langdetect.detect(text)
-            return detected if detected in self.supported_languages else 'en'
-        except:
-            return 'en'
+            candidates = langdetect.detect_langs(text)
+        except langdetect.LangDetectException:
+            candidates = []
+        if not candidates or candidates[0].lang not in self.supported_languages:
+            return fallback, 'fallback', {}
+
+        # Renormalized over supported languages, since only those can ever be answered in
+        supported = [candidate for candidate in candidates if candidate.lang in self.supported_languages]
+        total = sum(candidate.prob for candidate in supported)
+        probabilities = {candidate.lang: candidate.prob / total for candidate in supported}
+        return candidates[0].lang, 'langdetect', probabilities
+
+    def _detect_script(self, letters: List[str]) -> Optional[str]:
+        """Language of a non-Latin script that makes up most of the letters, if any"""
+        if not letters:
+            return None
+        joined = ''.join(letters)
+        for language, pattern in self.SCRIPT_PATTERNS:
+            count = len(pattern.findall(joined))
+            if language == 'ja' and count:
+                # Japanese mixes kana with kanji, so any kana decides it once CJK dominates
+                count += len(self.SCRIPT_PATTERNS[1][1].findall(joined))
+            if count * 2 > len(letters):
+                return language
+        return None
+
+    def get_tier_stats(self) -> Dict:
+        """Get how many messages each detection tier decided"""
+        return dict(self.tier_counts)
+
+    def warm_up(self):
+        """Load langdetect's language profiles, which it otherwise loads on the first detect call"""
+        langdetect.detector_factory.init_factory()
+        langdetect.detect_langs("warm up the language detector")
 
     def get_crisis_resources(self, language: str) -> str:
         """Get crisis resources in the detected language"""
         return self.crisis_resources.get(language, self.crisis_resources['en'])
 
 
+def phone_index_key(phone_number: str) -> str:
+    """Document ID of a phone number in the phone index, hashed so numbers aren't used as IDs"""
+    return hashlib.sha256(phone_number.encode('utf-8')).hexdigest()
+
+
+# Most writes a Firestore batch may hold
+FIRESTORE_BATCH_LIMIT = 500
+
+# Mood entries kept per user, keyed by write time under mental_health_data.mood_entries
+MOOD_TREND_SIZE = 30
+
+
+def mood_entry_key(now_ns: Optional[int] = None) -> str:
+    """
+    Key of a new mood entry: its write time, zero-padded so keys sort oldest first
+
+    A random suffix keeps entries written at the same instant by different
+    workers apart.
+    """
+    now_ns = time.time_ns() if now_ns is None else now_ns
+    return f'{now_ns:020d}_{os.urandom(2).hex()}'
+
+
+def mood_trend_entries(mental_health_data: Dict) -> List[Dict]:
+    """
+    A user's last MOOD_TREND_SIZE mood entries in order, oldest first
+
+    Entries from the older mood_trend list come first.
+    """
+    stored = mental_health_data.get('mood_entries') or {}
+    entries = [stored[key] for key in sorted(stored)]
+    return (list(mental_health_data.get('mood_trend', [])) + entries)[-MOOD_TREND_SIZE:]
+
+
 class UserSessionManager:
-    """Manage user sessions, conversation history, and profiles"""
+    """
+    Manage user sessions, conversation history, and profiles
+
+    Writes accept an optional Firestore WriteBatch so everything one message
+    writes can go out in a single commit. Firestore round trips are counted
+    per thread, see reset_round_trips().
+    """
 
-    def __init__(self, db, max_history: int = 50):
+    def __init__(self, db, max_history: int = 50, cache_size: Optional[int] = None,
+                 cache_ttl_seconds: Optional[float] = None, trim_slack: Optional[int] = None,
+                 retrieval_top_k: Optional[int] = None):
         self.db = db
-        self.sessions = {}  # In-memory session cache
+        if cache_size is None:
+            cache_size = int(os.getenv('USER_CACHE_SIZE', '10000'))
+        if cache_ttl_seconds is None:
+            cache_ttl_seconds = float(os.getenv('USER_CACHE_TTL_SECONDS', '300'))
+        self.sessions = ProfileCache(cache_size, cache_ttl_seconds)  # In-memory session cache
+        self.history_cache = ConversationWindowCache(
+            int(os.getenv('HISTORY_CACHE_USERS', '10000')),
+            int(os.getenv('HISTORY_CACHE_BYTES_PER_USER', '16384')),
+            ttl_seconds=cache_ttl_seconds
+        )
         self.max_history = max_history
+        # History is trimmed back to max_history once it is this many messages over
+        self.trim_slack = int(os.getenv('HISTORY_TRIM_SLACK', '25')) if trim_slack is None else trim_slack
+        # Optional relevance search over the stored history (0 disables it)
+        if retrieval_top_k is None:
+            retrieval_top_k = int(os.getenv('RETRIEVAL_TOP_K', '0'))
+        self.retrieval_top_k = retrieval_top_k
+        self.retrieval_memory = RetrievalMemory(
+            int(os.getenv('RETRIEVAL_MAX_USERS', '1000')), max_history, ttl_seconds=cache_ttl_seconds
+        ) if retrieval_top_k > 0 else None
+        self._local = threading.local()
+
+    @property
+    def round_trips(self) -> int:
+        """Firestore round trips made by this thread since reset_round_trips()"""
+        return getattr(self._local, 'round_trips', 0)
+
+    def reset_round_trips(self):
+        self._local.round_trips = 0
+
+    def _round_trip(self, count: int = 1):
+        self._local.round_trips = self.round_trips + count
+
+    def resolve_user_id(self, phone_number: str) -> Optional[str]:
+        """
+        Find a user's ID by phone number with one direct get from the phone index
+
+        Returns:
+            The user ID, or None if no user has this number
+        """
+        index_ref = self.db.collection('phone_index').document(phone_index_key(phone_number))
+        self._round_trip()
+        index_doc = index_ref.get()
+        if index_doc.exists:
+            return index_doc.to_dict()['user_id']
 
-    def get_or_create_user(self, phone_number: str) -> Dict:
-        """Get existing user or create new user profile"""
-        # Check Firestore for existing user
+        # Users created before the phone index existed are found by query once and indexed
         users_ref = self.db.collection('whatsapp_users')
-        query = users_ref.where('phone_number', '==', phone_number).limit(1)
+        self._round_trip()
+        users = list(users_ref.where('phone_number', '==', phone_number).limit(1).stream())
+        if not users:
+            return None
+        self._round_trip()
+        index_ref.set({'user_id': users[0].id})
+        return users[0].id
 
-        users = list(query.stream())
+    def get_or_create_user(self, phone_number: str, fresh: bool = False) -> Dict:
+        """
+        Get existing user or create new user profile
 
-        if users:
-            user_doc = users[0]
-            return {
-                'id': user_doc.id,
-                **user_doc.to_dict()
-            }
+        Args:
+            phone_number: User's WhatsApp phone number
+            fresh: Read a cached user's profile again from Firestore, for
+                callers that write back fields derived from it; only the phone
+                lookup is then served from the cache
+        """
+        if fresh:
+            user_id = self.sessions.user_id_for_phone(phone_number)
+            user = self.get_user(user_id, fresh=True) if user_id is not None else None
         else:
-            # Create new user
-            new_user = {
-                'phone_number': phone_number,
-                'created_at': firestore.SERVER_TIMESTAMP,
-                'last_interaction': firestore.SERVER_TIMESTAMP,
-                'conversation_count': 0,
-                'crisis_alerts': 0,
-                'preferred_language': 'en',
-                'check_in_enabled': True,
-                'user_profile': {
-                    'name': None,
-                    'age': None,
-                    'timezone': None
-                },
-                'mental_health_data': {
-                    'last_assessment': None,
-                    'risk_level': 'unknown',
-                    'mood_trend': []
+            user = self.sessions.get_by_phone(phone_number)
+        if user is not None:
+            return user
+
+        user_id = self.resolve_user_id(phone_number)
+        if user_id is None:
+            user_id, new_user = self._create_user(phone_number)
+            if new_user is not None:
+                user = {
+                    'id': user_id,
+                    **new_user
                 }
-            }
+                self.sessions.put(user_id, user)
+                # Cached with local times in place of the server timestamp placeholders
+                self.sessions.update(user_id, {'created_at': firestore.SERVER_TIMESTAMP,
+                                               'last_interaction': firestore.SERVER_TIMESTAMP})
+                return user
+
+        return self.get_user(user_id)
+
+    def get_user(self, user_id: str, fresh: bool = False) -> Optional[Dict]:
+        """Get a user profile by ID, from the session cache when possible unless fresh is set"""
+        user = None if fresh else self.sessions.get(user_id)
+        if user is not None:
+            return user
+
+        self._round_trip()
+        user_data = self.db.collection('whatsapp_users').document(user_id).get().to_dict()
+        if user_data is None:
+            return None
+        user = {
+            'id': user_id,
+            **user_data
+        }
+        self.sessions.put(user_id, user)
+        return user
 
-            doc_ref = users_ref.document()
-            doc_ref.set(new_user)
+    def update_user_fields(self, user_id: str, fields: Dict, batch=None):
+        """Update fields of a user profile in Firestore (or in a batch) and in the session cache"""
+        user_ref = self.db.collection('whatsapp_users').document(user_id)
+        if batch is None:
+            self._round_trip()
+            user_ref.update(fields)
+        else:
+            batch.update(user_ref, fields)
+        self.sessions.update(user_id, fields)
 
-            return {
-                'id': doc_ref.id,
-                **new_user
+    def commit_batch(self, batch, user_id: str):
+        """Commit a batch of one message's writes, dropping the cached profile if it fails"""
+        self._round_trip()
+        try:
+            batch.commit()
+        except Exception:
+            # The caches already have the batch's changes; read them again next time
+            self.sessions.invalidate(user_id)
+            self.history_cache.invalidate(user_id)
+            if self.retrieval_memory is not None:
+                self.retrieval_memory.invalidate(user_id)
+            raise
+
+    def _create_user(self, phone_number: str) -> Tuple[str, Optional[Dict]]:
+        """
+        Create a user and its phone index entry in one transaction
+
+        If another message from the same number created the user first, the
+        transaction sees its index entry and nothing is written.
+
+        Returns:
+            (user ID, new user profile), with None as the profile when the
+            user already existed
+        """
+        users_ref = self.db.collection('whatsapp_users')
+        index_ref = self.db.collection('phone_index').document(phone_index_key(phone_number))
+        user_ref = users_ref.document()
+        new_user = {
+            'phone_number': phone_number,
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'last_interaction': firestore.SERVER_TIMESTAMP,
+            'conversation_count': 0,
+            'crisis_alerts': 0,
+            'preferred_language': 'en',
+            'check_in_enabled': True,
+            'user_profile': {
+                'name': None,
+                'age': None,
+                'timezone': None
+            },
+            'mental_health_data': {
+                'last_assessment': None,
+                'risk_level': 'unknown',
+                'mood_entries': {}
             }
+        }
 
-    def update_user_activity(self, user_id: str, language: str = None, crisis_detected: bool = False):
+        @firestore.transactional
+        def create(transaction):
+            index_doc = index_ref.get(transaction=transaction)
+            if index_doc.exists:
+                return index_doc.to_dict()['user_id'], None
+            transaction.set(user_ref, new_user)
+            transaction.set(index_ref, {'user_id': user_ref.id})
+            return user_ref.id, new_user
+
+        # Transactional read plus commit
+        self._round_trip(2)
+        return create(self.db.transaction())
+
+    def update_user_activity(self, user_id: str, language: str = None, crisis_detected: bool = False,
+                             rolling_risk: Optional[Dict] = None, language_profile: Optional[Dict] = None,
+                             batch=None):
         """Update user activity and statistics"""
-        user_ref = self.db.collection('whatsapp_users').document(user_id)
-
         update_data = {
             'last_interaction': firestore.SERVER_TIMESTAMP,
             'conversation_count': firestore.Increment(1)
@@ -302,23 +1627,42 @@ class UserSessionManager:
             update_data['crisis_alerts'] = firestore.Increment(1)
             update_data['mental_health_data.risk_level'] = 'high'
 
-        user_ref.update(update_data)
+        if rolling_risk is not None:
+            update_data['mental_health_data.rolling_risk'] = rolling_risk
+
+        if language_profile is not None:
+            update_data['language_profile'] = language_profile
+
+        self.update_user_fields(user_id, update_data, batch)
 
     def get_conversation_history(self, user_id: str, limit: int = 10) -> List[Dict]:
-        """Retrieve recent conversation history"""
+        """Retrieve recent conversation history, from the window cache when possible"""
+        cached = self.history_cache.get(user_id, limit)
+        if cached is not None:
+            return cached
+
         messages_ref = self.db.collection('whatsapp_messages')
-        query = messages_ref.where('user_id', '==', user_id).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(limit)
+        query_limit = max(limit, self.history_cache.window)
+        query = messages_ref.where('user_id', '==', user_id).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(query_limit)
 
+        self._round_trip()
         messages = []
         for msg in query.stream():
             messages.append(msg.to_dict())
 
-        return list(reversed(messages))  # Return in chronological order
+        messages.reverse()  # Return in chronological order
+        self.history_cache.seed(user_id, messages)
+        return messages[-limit:]
 
     def save_conversation(self, user_id: str, user_message: str, bot_response: str,
-                         sentiment: Dict, crisis_info: Dict, language: str):
-        """Save conversation to Firestore"""
-        self.db.collection('whatsapp_messages').add({
+                         sentiment: Dict, crisis_info: Dict, language: str, batch=None):
+        """
+        Save conversation to Firestore
+
+        With a batch the message is only added to it, and the caller trims the
+        history with trim_history_if_due() once the batch is committed.
+        """
+        message_data = {
             'user_id': user_id,
             'user_message': user_message,
             'bot_response': bot_response,
@@ -326,45 +1670,148 @@ class UserSessionManager:
             'crisis_info': crisis_info,
             'language': language,
             'timestamp': firestore.SERVER_TIMESTAMP
-        })
-        self._trim_conversation_history(user_id)
+        }
+        if batch is None:
+            self._round_trip()
+            self.db.collection('whatsapp_messages').add(message_data)
+        else:
+            batch.set(self.db.collection('whatsapp_messages').document(), message_data)
+        self.history_cache.append(user_id, {**message_data, 'timestamp': datetime.now(timezone.utc)})
+        if self.retrieval_memory is not None:
+            self.retrieval_memory.add(user_id, message_data)
+
+        # Stored messages are counted on the user so the history is only queried
+        # for trimming once every trim_slack messages rather than on every save
+        self.update_user_fields(user_id, {'history_count': firestore.Increment(1)}, batch)
+        if batch is None:
+            self.trim_history_if_due(user_id)
+
+    def find_related_exchanges(self, user_id: str, text: str, exclude_recent: int = 0) -> List[Dict]:
+        """
+        Past exchanges most relevant to a message, if retrieval memory is enabled
+
+        The user's stored history is read and indexed once; after that the
+        index is updated as messages are saved.
+
+        Args:
+            exclude_recent: Number of newest exchanges to leave out, e.g. those already in the prompt
+        """
+        if self.retrieval_memory is None:
+            return []
+        results = self.retrieval_memory.search(user_id, text, self.retrieval_top_k, exclude_recent)
+        if results is None:
+            self.retrieval_memory.seed(user_id, self.get_conversation_history(user_id, self.max_history))
+            results = self.retrieval_memory.search(user_id, text, self.retrieval_top_k, exclude_recent)
+        return [exchange for _, exchange in results or []]
+
+    def trim_history_if_due(self, user_id: str):
+        """Trim the user's history if it is more than trim_slack messages over max_history"""
+        user = self.get_user(user_id) or {}
+        if user.get('history_count', 0) > self.max_history + self.trim_slack:
+            self._trim_conversation_history(user_id)
 
     def _trim_conversation_history(self, user_id: str):
-        """Keep only the most recent messages for a user."""
+        """Keep only the most recent messages for a user, deleting older ones in batches"""
         messages_ref = self.db.collection('whatsapp_messages')
         recent_query = (
             messages_ref.where('user_id', '==', user_id)
             .order_by('timestamp', direction=firestore.Query.DESCENDING)
             .limit(self.max_history)
         )
+        self._round_trip()
         recent_docs = list(recent_query.stream())
-        if len(recent_docs) < self.max_history:
-            return
 
-        last_doc = recent_docs[-1]
-        old_query = (
-            messages_ref.where('user_id', '==', user_id)
-            .order_by('timestamp', direction=firestore.Query.DESCENDING)
-            .start_after(last_doc)
-        )
-        for old_doc in old_query.stream():
-            old_doc.reference.delete()
+        if len(recent_docs) >= self.max_history:
+            old_query = (
+                messages_ref.where('user_id', '==', user_id)
+                .order_by('timestamp', direction=firestore.Query.DESCENDING)
+                .start_after(recent_docs[-1])
+            )
+            self._round_trip()
+            batch = self.db.batch()
+            pending = 0
+            for old_doc in old_query.stream():
+                batch.delete(old_doc.reference)
+                pending += 1
+                if pending == FIRESTORE_BATCH_LIMIT:
+                    self._round_trip()
+                    batch.commit()
+                    batch = self.db.batch()
+                    pending = 0
+            if pending:
+                self._round_trip()
+                batch.commit()
+
+        self.update_user_fields(user_id, {'history_count': len(recent_docs)})
+
+
+# Word pieces for local token estimates: about one token per 4 characters of a word, one per symbol
+TOKEN_PIECE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    """Estimate the LLM tokens of a text without a tokenizer"""
+    return sum(1 + (len(piece) - 1) // 4 for piece in TOKEN_PIECE_PATTERN.findall(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cut a text to at most max_tokens tokens, marking the cut with an ellipsis (one token)"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    used = 0
+    for match in TOKEN_PIECE_PATTERN.finditer(text):
+        used += 1 + (len(match.group(0)) - 1) // 4
+        if used > max_tokens - 1:
+            return text[:match.start()].rstrip() + '…'
+    return text
 
 
 class ConversationMemory:
-    """Enhanced conversation memory with context management"""
+    """
+    Enhanced conversation memory with context management
 
-    def __init__(self, user_id: str, conversation_history: List[Dict] = None):
+    Keeps the latest exchanges verbatim, up to 5 and, with a token budget, no
+    more than max_tokens of them. add_exchange returns the exchanges that no
+    longer fit, so they can be folded into a summary.
+    """
+
+    def __init__(self, user_id: str, conversation_history: List[Dict] = None,
+                 max_tokens: Optional[int] = None):
         self.user_id = user_id
+        self.max_tokens = max_tokens
         self.memory = ConversationBufferWindowMemory(k=5)  # Remember last 5 exchanges
 
         # Load previous conversation history
         if conversation_history:
             for msg in conversation_history[-5:]:  # Load last 5 messages
-                self.memory.save_context(
-                    {"input": msg.get('user_message', '')},
-                    {"output": msg.get('bot_response', '')}
-                )
+                self.add_exchange(msg.get('user_message', ''), msg.get('bot_response', ''))
+
+    def token_count(self) -> int:
+        """Estimated tokens of the remembered messages"""
+        return sum(count_tokens(message.content) for message in self.memory.chat_memory.messages)
+
+    def add_exchange(self, user_message: str, bot_response: str) -> List[Tuple[str, str]]:
+        """
+        Remember one more exchange, e.g. right after replying
+
+        Returns:
+            The oldest (user message, bot response) pairs dropped to stay within
+            the window and the token budget
+        """
+        if self.max_tokens is not None:
+            # A single long message can't take more than its half of the budget
+            user_message = truncate_tokens(user_message, self.max_tokens // 2)
+            bot_response = truncate_tokens(bot_response, self.max_tokens // 2)
+        self.memory.save_context({"input": user_message}, {"output": bot_response})
+
+        # The window memory only limits what it loads, so drop messages outside it
+        messages = self.memory.chat_memory.messages
+        dropped = []
+        while len(messages) > 2 and (len(messages) > 2 * self.memory.k or
+                                     (self.max_tokens is not None and self.token_count() > self.max_tokens)):
+            dropped.append((messages[0].content, messages[1].content))
+            del messages[:2]
+        return dropped
 
     def get_context_summary(self) -> str:
         """Get a summary of the conversation context"""
@@ -372,6 +1819,112 @@ class ConversationMemory:
         return history.get('history', '')
 
 
+class ContextBuilder:
+    """
+    Token-budgeted conversation context for the prompt
+
+    The latest exchanges are kept verbatim by a ConversationMemory with a
+    history budget; older exchanges are folded into a short rolling summary
+    (one line per exchange with the start of the user's message) that is kept
+    on the user document and trimmed oldest first to its own budget.
+    """
+
+    def __init__(self, history_tokens: Optional[int] = None, summary_tokens: Optional[int] = None,
+                 line_tokens: int = 24):
+        if history_tokens is None:
+            history_tokens = int(os.getenv('PROMPT_HISTORY_TOKENS', '600'))
+        if summary_tokens is None:
+            summary_tokens = int(os.getenv('PROMPT_SUMMARY_TOKENS', '150'))
+        self.history_tokens = history_tokens
+        self.summary_tokens = summary_tokens
+        self.line_tokens = line_tokens
+
+    def fold(self, summary: str, exchanges: List[Tuple[str, str]]) -> str:
+        """Add exchanges that left the verbatim window to the rolling summary"""
+        lines = [line for line in (summary or '').split('\n') if line]
+        for user_message, _ in exchanges:
+            first_sentence = re.split(r'(?<=[.!?])\s', user_message.strip(), maxsplit=1)[0]
+            lines.append(f"- User said: {truncate_tokens(first_sentence, self.line_tokens)}")
+        while lines and count_tokens('\n'.join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        return '\n'.join(lines)
+
+    def history(self, summary: str, memory: ConversationMemory, related: Optional[List[Dict]] = None) -> str:
+        """The prompt's history: the rolling summary, related past exchanges, then the verbatim exchanges"""
+        sections = []
+        if summary:
+            sections.append(f"Earlier in the conversation:\n{summary}")
+        if related:
+            # Shortened like summary lines so retrieval doesn't grow the prompt much
+            lines = [
+                f"- User said: {truncate_tokens(exchange['user_message'], self.line_tokens)} / "
+                f"You replied: {truncate_tokens(exchange['bot_response'], self.line_tokens)}"
+                for exchange in related
+            ]
+            sections.append("Related earlier messages:\n" + '\n'.join(lines))
+        sections.append(memory.get_context_summary())
+        return '\n\n'.join(sections) if len(sections) > 1 else sections[0]
+
+
+class ConversationMemoryCache:
+    """
+    Live ConversationMemory objects of recently active users, in an LRU with a TTL
+
+    Memories are updated after each reply instead of being rebuilt from the
+    conversation history on every message. After eviction, expiry or a
+    restart a user's memory is rebuilt from the history once.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl_seconds: float = 300.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # user ID -> (expires at, memory)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: str) -> Optional[ConversationMemory]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[user_id]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id: str, memory: ConversationMemory):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl_seconds, memory)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict:
+        """Get size and hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else None
+            }
+
+
 class Empathibot:
     """
     Advanced AI Mental Health Support Chatbot
@@ -382,8 +1935,20 @@ class Empathibot:
         self.db = db
         self.llm = llm
         self.crisis_detector = CrisisDetector()
+        self.risk_tracker = RollingRiskTracker()
         self.language_handler = LanguageHandler()
         self.session_manager = UserSessionManager(db)
+        self.context_builder = ContextBuilder()
+        # Estimated prompt tokens of recent LLM calls
+        self.prompt_token_counts = deque(maxlen=1000)
+        self.conversation_memories = ConversationMemoryCache(
+            int(os.getenv('CONVERSATION_MEMORY_CACHE_SIZE', '1000')),
+            self.session_manager.sessions.ttl_seconds
+        )
+        self.sentiment_analyzer = SentimentAnalyzer()
+        self.sentiment_cache = ResultCache(int(os.getenv('SENTIMENT_CACHE_SIZE', '10000')))
+        # Firestore round trips of recent process_message calls
+        self.round_trip_counts = deque(maxlen=1000)
 
         # Enhanced prompt template for empathetic responses
         self.prompt_template = PromptTemplate(
@@ -414,6 +1979,24 @@ Guidelines for your response:
 Your empathetic response:"""
         )
 
+        # Built once and shared by all conversations; each call passes the user's history
+        self.conversation_chain = LLMChain(llm=self.llm, prompt=self.prompt_template, verbose=False)
+
+    def warm_up(self) -> Dict[str, float]:
+        """
+        Load lazily initialized components up front, e.g. before gunicorn forks workers
+
+        Returns:
+            Dict of component name to warm-up time in milliseconds
+        """
+        timings = {}
+        for component, warm_up in [('langdetect_profiles', self.language_handler.warm_up),
+                                   ('crisis_detector', self.crisis_detector.warm_up)]:
+            started = time.perf_counter()
+            warm_up()
+            timings[component] = (time.perf_counter() - started) * 1000
+        return timings
+
     def process_message(self, phone_number: str, message: str) -> str:
         """
         Main message processing pipeline
@@ -425,31 +2008,55 @@ Your empathetic response:"""
         Returns:
             str: Bot response to send back
         """
-        # 1. Get or create user profile
-        user = self.session_manager.get_or_create_user(phone_number)
+        self.session_manager.reset_round_trips()
+        # Everything this message writes goes out in one batch commit
+        batch = self.db.batch()
+
+        # 1. Get or create user profile, read fresh since the rolling risk, language
+        #    profile and summary are written back from it and other workers may have
+        #    changed them since it was cached
+        user = self.session_manager.get_or_create_user(phone_number, fresh=True)
         user_id = user['id']
 
-        # 2. Detect language
-        language = self.language_handler.detect_language(message)
+        # 2. Detect language, sticking to the user's established language
+        language_info, language_profile = self.language_handler.detect_for_user(
+            message, user.get('language_profile'), user.get('preferred_language')
+        )
+        language = language_info['language']
 
         # 3. Crisis detection
         crisis_info = self.crisis_detector.detect_crisis(message)
 
+        # Escalate when risk builds up across messages that are each below the crisis line
+        rolling_risk = self.risk_tracker.update(
+            user.get('mental_health_data', {}).get('rolling_risk'), crisis_info['severity_score']
+        )
+        crisis_info['rolling_risk_score'] = rolling_risk['score']
+        if not crisis_info['is_crisis'] and self.risk_tracker.is_escalated(rolling_risk):
+            crisis_info['is_crisis'] = True
+            crisis_info['severity'] = 'high'
+
         # 4. If crisis detected, handle immediately
         if crisis_info['is_crisis']:
             crisis_response = self.crisis_detector.get_crisis_response(crisis_info['severity'])
 
-            # Update user profile with crisis alert
-            self.session_manager.update_user_activity(user_id, language, crisis_detected=True)
+            # Update user profile with crisis alert; the rolling risk starts over once help was offered
+            self.session_manager.update_user_activity(
+                user_id, language, crisis_detected=True, rolling_risk=self.risk_tracker.reset(),
+                language_profile=language_profile, batch=batch
+            )
 
             # Log crisis incident
-            self.db.collection('crisis_alerts').add({
+            batch.set(self.db.collection('crisis_alerts').document(), {
                 'user_id': user_id,
                 'phone_number': phone_number,
                 'message': message,
                 'severity': crisis_info['severity'],
                 'severity_score': crisis_info['severity_score'],
+                'model_score': crisis_info['model_score'],
+                'rolling_risk_score': crisis_info['rolling_risk_score'],
                 'matched_keywords': crisis_info['matched_keywords'],
+                'lexicon_version': crisis_info['lexicon_version'],
                 'timestamp': firestore.SERVER_TIMESTAMP,
                 'response_sent': crisis_response
             })
@@ -457,14 +2064,20 @@ Your empathetic response:"""
             # Save conversation
             sentiment = {"sentiment": "negative", "confidence": 0.9}
             self.session_manager.save_conversation(
-                user_id, message, crisis_response, sentiment, crisis_info, language
+                user_id, message, crisis_response, sentiment, crisis_info, language, batch=batch
             )
+            # Rebuilt from the (cached) history next time, including this exchange
+            self.conversation_memories.invalidate(user_id)
+            self._commit_message_writes(batch, user_id)
 
             return crisis_response
 
-        # 5. Get conversation history and build memory
-        conversation_history = self.session_manager.get_conversation_history(user_id)
-        memory = ConversationMemory(user_id, conversation_history)
+        # 5. Get the user's live conversation memory, building it from the history if needed
+        memory = self.conversation_memories.get(user_id)
+        if memory is None:
+            conversation_history = self.session_manager.get_conversation_history(user_id)
+            memory = ConversationMemory(user_id, conversation_history, self.context_builder.history_tokens)
+            self.conversation_memories.put(user_id, memory)
 
         # 6. Build context
         context_parts = []
@@ -480,79 +2093,125 @@ Your empathetic response:"""
         context = " | ".join(context_parts) if context_parts else "New conversation"
 
         # 7. Generate empathetic response using LangChain
-        conversation_chain = LLMChain(
-            llm=self.llm,
-            memory=memory.memory,
-            prompt=self.prompt_template,
-            verbose=False
-        )
-
-        # Generate response
+        # The memory is passed as history rather than attached to the chain, so
+        # it keeps the user's own message instead of the context-prefixed input
         combined_input = f"Context: {context}\n\nUser message: {message}"
-        ai_response = conversation_chain.predict(input=combined_input)
+        conversation_summary = user.get('conversation_summary', '')
+        related = self.session_manager.find_related_exchanges(
+            user_id, message, exclude_recent=len(memory.memory.chat_memory.messages) // 2
+        )
+        history = self.context_builder.history(conversation_summary, memory, related)
+        self.prompt_token_counts.append(
+            count_tokens(self.prompt_template.format(history=history, input=combined_input))
+        )
+        ai_response = self.conversation_chain.predict(input=combined_input, history=history)
 
         # 8. Post-process response
         # Add crisis resources if moderate severity detected
         if crisis_info['severity'] == 'moderate':
             ai_response += f"\n\n💙 Remember, if you need immediate support: {self.language_handler.get_crisis_resources(language)}"
 
-        # 9. Sentiment analysis (basic)
+        dropped = memory.add_exchange(message, ai_response)
+
+        # 9. Sentiment analysis
         sentiment = self._analyze_sentiment(message)
 
         # 10. Update user activity
-        self.session_manager.update_user_activity(user_id, language, crisis_detected=False)
+        self.session_manager.update_user_activity(
+            user_id, language, crisis_detected=False, rolling_risk=rolling_risk,
+            language_profile=language_profile, batch=batch
+        )
+        if dropped:
+            self.session_manager.update_user_fields(user_id, {
+                'conversation_summary': self.context_builder.fold(conversation_summary, dropped)
+            }, batch)
 
         # 11. Save conversation
         self.session_manager.save_conversation(
-            user_id, message, ai_response, sentiment, crisis_info, language
+            user_id, message, ai_response, sentiment, crisis_info, language, batch=batch
         )
 
         # 12. Update mood tracking
-        self._update_mood_tracking(user_id, sentiment, crisis_info)
+        self._update_mood_tracking(
+            user_id, sentiment, crisis_info,
+            mental_health_data=user.get('mental_health_data', {}), batch=batch
+        )
+        self._commit_message_writes(batch, user_id)
 
         return ai_response
 
-    def _analyze_sentiment(self, text: str) -> Dict:
-        """Basic sentiment analysis"""
-        positive_words = ['happy', 'good', 'great', 'better', 'excellent', 'wonderful',
-                         'love', 'joy', 'grateful', 'thankful', 'blessed', 'excited']
-        negative_words = ['sad', 'bad', 'terrible', 'awful', 'horrible', 'hate',
-                         'depressed', 'anxious', 'worried', 'scared', 'angry', 'upset']
-
-        text_lower = text.lower()
-        positive_count = sum(1 for word in positive_words if word in text_lower)
-        negative_count = sum(1 for word in negative_words if word in text_lower)
+    def _commit_message_writes(self, batch, user_id: str):
+        """Commit a message's writes, trim the history when due and record the round trips"""
+        try:
+            self.session_manager.commit_batch(batch, user_id)
+        except Exception:
+            # The live memory already holds this exchange; rebuild it from the stored history
+            self.conversation_memories.invalidate(user_id)
+            raise
+        self.session_manager.trim_history_if_due(user_id)
+        self.round_trip_counts.append(self.session_manager.round_trips)
+
+    def get_prompt_token_stats(self) -> Dict:
+        """Get the LLM call count and recent p50/p99/max estimated prompt tokens"""
+        counts = list(self.prompt_token_counts)
+        return {
+            'count': len(counts),
+            'p50': percentile(counts, 50),
+            'p99': percentile(counts, 99),
+            'max': max(counts) if counts else None
+        }
 
-        if positive_count > negative_count:
-            return {"sentiment": "positive", "score": positive_count}
-        elif negative_count > positive_count:
-            return {"sentiment": "negative", "score": negative_count}
-        else:
-            return {"sentiment": "neutral", "score": 0}
+    def get_round_trip_stats(self) -> Dict:
+        """Get the message count and recent p50/p99/max Firestore round trips per message"""
+        counts = list(self.round_trip_counts)
+        return {
+            'count': len(counts),
+            'p50': percentile(counts, 50),
+            'p99': percentile(counts, 99),
+            'max': max(counts) if counts else None
+        }
 
-    def _update_mood_tracking(self, user_id: str, sentiment: Dict, crisis_info: Dict):
-        """Update user's mood trend for analytics"""
-        user_ref = self.db.collection('whatsapp_users').document(user_id)
+    def _analyze_sentiment(self, text: str) -> Dict:
+        """Lexicon sentiment analysis, memoized for repeated messages"""
+        text_lower = text.lower()
+        key = ResultCache.make_key(text_lower)
+        result = self.sentiment_cache.get(key)
+        if result is None:
+            result = self.sentiment_analyzer.analyze(text_lower)
+            self.sentiment_cache.put(key, result)
+        return result
+
+    def _update_mood_tracking(self, user_id: str, sentiment: Dict, crisis_info: Dict,
+                              mental_health_data: Optional[Dict] = None, batch=None):
+        """
+        Update user's mood trend for analytics
 
+        The entry is added under a key of its own, so messages handled
+        concurrently can't overwrite each other's entries, and entries older
+        than the last 30 are deleted in the same blind write. A stale
+        mental_health_data only leaves extra entries for a later write to
+        delete; it is read from the profile if not given.
+        """
         mood_entry = {
             'timestamp': datetime.now().isoformat(),
             'sentiment': sentiment['sentiment'],
             'crisis_severity': crisis_info['severity']
         }
 
-        # Keep last 30 mood entries
-        user_data = user_ref.get().to_dict() or {}
-        mood_trend = user_data.get('mental_health_data', {}).get('mood_trend', [])
-        mood_trend.append(mood_entry)
-        trimmed_trend = mood_trend[-30:]
-        user_ref.update({
-            'mental_health_data.mood_trend': trimmed_trend
-        })
+        if mental_health_data is None:
+            mental_health_data = (self.session_manager.get_user(user_id) or {}).get('mental_health_data', {})
+        fields = {f'mental_health_data.mood_entries.{mood_entry_key()}': mood_entry}
+        old_keys = sorted(mental_health_data.get('mood_entries') or {})
+        for key in old_keys[:max(0, len(old_keys) - (MOOD_TREND_SIZE - 1))]:
+            fields[f'mental_health_data.mood_entries.{key}'] = firestore.DELETE_FIELD
+        # The older mood_trend list is out of the trend once the entries fill it
+        if 'mood_trend' in mental_health_data and len(old_keys) >= MOOD_TREND_SIZE - 1:
+            fields['mental_health_data.mood_trend'] = firestore.DELETE_FIELD
+        self.session_manager.update_user_fields(user_id, fields, batch)
 
     def send_check_in(self, user_id: str) -> str:
         """Generate a wellness check-in message"""
-        user_ref = self.db.collection('whatsapp_users').document(user_id)
-        user = user_ref.get().to_dict()
+        user = self.session_manager.get_user(user_id)
 
         name = user.get('user_profile', {}).get('name', 'friend')
 
@@ -568,10 +2227,9 @@ Your empathetic response:"""
 
     def get_user_insights(self, user_id: str) -> Dict:
         """Get analytics and insights for a user"""
-        user_ref = self.db.collection('whatsapp_users').document(user_id)
-        user = user_ref.get().to_dict()
+        user = self.session_manager.get_user(user_id)
 
-        mood_trend = user.get('mental_health_data', {}).get('mood_trend', [])
+        mood_trend = mood_trend_entries(user.get('mental_health_data', {}))
 
         # Analyze mood trend
         recent_moods = mood_trend[-7:] if len(mood_trend) >= 7 else mood_trend
@@ -0,0 +1,42 @@
+"""
+Gunicorn configuration
+
+Set GUNICORN_PRELOAD=true to import the app once in the master (preload_app),
+so langdetect's language profiles and the compiled crisis lexicon are loaded
+before workers fork and shared copy-on-write, instead of stalling each
+worker's first message.
+
+Preloading is off by default: gRPC (used by the Firestore client) does not
+support fork once it is in use, so nothing may talk to Firestore in the
+master. The check-in scheduler does, so it can't be combined with preloading;
+run it in its own process instead.
+"""
+
+import gc
+import os
+
+
+def _enabled(name, default="false"):
+    return os.getenv(name, default).lower() in {"1", "true", "yes"}
+
+
+preload_app = _enabled("GUNICORN_PRELOAD")
+
+if preload_app and _enabled("ENABLE_SCHEDULER"):
+    raise RuntimeError(
+        "ENABLE_SCHEDULER would start Firestore traffic in the gunicorn master when GUNICORN_PRELOAD "
+        "is on; run the scheduler in a separate process or turn preloading off"
+    )
+
+
+def when_ready(server):
+    # Keep the garbage collector from touching (and so copying) the preloaded objects in workers
+    if server.cfg.preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        import app
+
+        app.start_lexicon_watcher()
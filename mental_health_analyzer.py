@@ -0,0 +1,80 @@
+"""
+Mental Health Assessment Tools
+PHQ-9 / GAD-7 scoring, text sentiment and recommendations for the web assessment
+"""
+
+from sentiment import SentimentAnalyzer
+
+
+class MentalHealthAnalyzer:
+    def __init__(self):
+        self.sentiment_analyzer = SentimentAnalyzer()
+        self.phq9_questions = [
+            "Little interest or pleasure in doing things",
+            "Feeling down, depressed, or hopeless",
+            "Trouble falling or staying asleep, or sleeping too much",
+            "Feeling tired or having little energy",
+            "Poor appetite or overeating",
+            "Feeling bad about yourself or that you are a failure",
+            "Trouble concentrating on things",
+            "Moving or speaking slowly, or being fidgety/restless",
+            "Thoughts that you would be better off dead or hurting yourself"
+        ]
+        
+        self.gad7_questions = [
+            "Feeling nervous, anxious, or on edge",
+            "Not being able to stop or control worrying",
+            "Worrying too much about different things",
+            "Trouble relaxing",
+            "Being so restless that it is hard to sit still",
+            "Becoming easily annoyed or irritable",
+            "Feeling afraid as if something awful might happen"
+        ]
+    
+    def analyze_phq9_score(self, scores):
+        total = sum(scores)
+        if total <= 4:
+            return {"level": "minimal", "description": "Minimal depression symptoms"}
+        elif total <= 9:
+            return {"level": "mild", "description": "Mild depression symptoms"}
+        elif total <= 14:
+            return {"level": "moderate", "description": "Moderate depression symptoms"}
+        elif total <= 19:
+            return {"level": "moderately_severe", "description": "Moderately severe depression symptoms"}
+        else:
+            return {"level": "severe", "description": "Severe depression symptoms"}
+    
+    def analyze_gad7_score(self, scores):
+        total = sum(scores)
+        if total <= 4:
+            return {"level": "minimal", "description": "Minimal anxiety symptoms"}
+        elif total <= 9:
+            return {"level": "mild", "description": "Mild anxiety symptoms"}
+        elif total <= 14:
+            return {"level": "moderate", "description": "Moderate anxiety symptoms"}
+        else:
+            return {"level": "severe", "description": "Severe anxiety symptoms"}
+    
+    def analyze_text_sentiment(self, text):
+        # Same lexicon, weights and negation handling as the WhatsApp bot
+        return self.sentiment_analyzer.analyze(text)
+    
+    def generate_recommendations(self, phq9_result, gad7_result, sentiment_analysis):
+        recommendations = []
+        
+        if phq9_result["level"] in ["moderate", "moderately_severe", "severe"]:
+            recommendations.append("Consider speaking with a mental health professional")
+            recommendations.append("Practice daily self-care activities")
+            recommendations.append("Maintain a regular sleep schedule")
+        
+        if gad7_result["level"] in ["moderate", "severe"]:
+            recommendations.append("Try relaxation techniques like deep breathing")
+            recommendations.append("Consider mindfulness or meditation practices")
+            recommendations.append("Limit caffeine intake")
+        
+        if sentiment_analysis["sentiment"] == "negative":
+            recommendations.append("Engage in activities you enjoy")
+            recommendations.append("Connect with supportive friends or family")
+            recommendations.append("Consider journaling your thoughts")
+        
+        return recommendations
@@ -85,8 +85,7 @@ class CheckInScheduler:
                 print(f"✅ Check-in sent to {phone_number}: {message.sid}")
 
                 # Update user's last check-in time
-                user_ref = self.db.collection('whatsapp_users').document(user_id)
-                user_ref.update({
+                self.empathibot.session_manager.update_user_fields(user_id, {
                     'last_check_in': firestore.SERVER_TIMESTAMP
                 })
 
@@ -153,8 +152,7 @@ class CheckInScheduler:
     def send_crisis_follow_up(self, user_id: str, severity: str):
         """Send follow-up after a crisis alert"""
         try:
-            user_ref = self.db.collection('whatsapp_users').document(user_id)
-            user = user_ref.get().to_dict()
+            user = self.empathibot.session_manager.get_user(user_id)
 
             if not user:
                 print(f"❌ User {user_id} not found for crisis follow-up")
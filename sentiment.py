@@ -0,0 +1,283 @@
+"""
+Sentiment Analysis
+Word-boundary sentiment lexicon with weights and negation, shared by the
+WhatsApp bot and the web assessment so both report the same scores
+"""
+
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Tokens as seen by both sentiment and crisis negation checks
+WORD_PATTERN = re.compile(r"[a-z']+")
+
+NEGATION_WORDS = frozenset({
+    'not', "don't", 'dont', 'never', 'no', 'without', "isn't", 'isnt',
+    "can't", 'cant', "won't", 'wont', "didn't", 'didnt', "doesn't", 'doesnt',
+    "wasn't", 'wasnt', "aren't", 'arent'
+})
+
+# Number of words before a match that are checked for a negation
+NEGATION_WINDOW = 3
+
+# Batch scoring joins messages with this separator, which is never part of a token
+BATCH_SEPARATOR = '\x00'
+
+# Bytes that are part of a WORD_PATTERN token, and ASCII whitespace as str.split() sees it
+TOKEN_BYTES = np.zeros(256, dtype=bool)
+TOKEN_BYTES[list(b"abcdefghijklmnopqrstuvwxyz'")] = True
+WHITESPACE_BYTES = np.zeros(256, dtype=bool)
+WHITESPACE_BYTES[list(b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f")] = True
+
+POSITIVE_WORDS = {
+    'happy': 1, 'good': 1, 'great': 1, 'better': 1, 'excellent': 2, 'amazing': 2,
+    'wonderful': 2, 'fantastic': 2, 'love': 2, 'joy': 1, 'grateful': 1, 'thankful': 1,
+    'blessed': 1, 'excited': 1
+}
+
+NEGATIVE_WORDS = {
+    'sad': 1, 'bad': 1, 'terrible': 2, 'awful': 2, 'horrible': 2, 'hate': 2,
+    'depressed': 2, 'anxious': 1, 'worried': 1, 'scared': 1, 'angry': 1, 'upset': 1
+}
+
+
+def tokenize(text_lower: str) -> Tuple[List[str], List[int]]:
+    """Split lowercased text into words and their end offsets"""
+    words = []
+    ends = []
+    for match in WORD_PATTERN.finditer(text_lower):
+        words.append(match.group(0))
+        ends.append(match.end())
+    return words, ends
+
+
+def trie_alternation(words: Iterable[str]) -> str:
+    """Regex alternation of words factored by common prefixes, which re matches faster than a flat list"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node: Dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # Greedy, so the longest word still wins where one word is a prefix of another
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie) if trie else '(?!)'
+
+
+class SentimentAnalyzer:
+    """
+    Lexicon sentiment scorer
+
+    Each positive or negative word adds its weight to that side, unless one of
+    the previous NEGATION_WINDOW words is a negation, in which case it counts for
+    the opposite side ("not happy" is negative, "not bad" positive). Words only
+    match whole tokens of WORD_PATTERN, so "good" doesn't match "goodbye".
+
+    Messages are scored with one compiled regex over the sentiment and negation
+    words, and analyze_many() gives the same totals from NumPy arrays over a
+    whole batch of messages.
+    """
+
+    def __init__(self, positive_words: Optional[Dict[str, int]] = None,
+                 negative_words: Optional[Dict[str, int]] = None):
+        self.positive_words = dict(POSITIVE_WORDS if positive_words is None else positive_words)
+        self.negative_words = dict(NEGATIVE_WORDS if negative_words is None else negative_words)
+        # Signed weight per word: positive words above zero, negative words below
+        self.weights = {word: weight for word, weight in self.positive_words.items()}
+        self.weights.update({word: -weight for word, weight in self.negative_words.items()})
+
+        # Whole tokens only: no token character may touch either side of a match
+        alternation = trie_alternation(set(self.weights) | NEGATION_WORDS)
+        self.pattern = re.compile(rf"(?<![a-z'])(?:{alternation})(?![a-z'])")
+
+        # Batch scoring packs each token's bytes into fixed-width integer keys and
+        # looks them up in the sorted keys of these words (the word ID is the index).
+        # Tokens whose first byte, last byte and length match no word are skipped first.
+        words = sorted(set(self.weights) | NEGATION_WORDS)
+        encoded_words = [word.encode('utf-8') for word in words]
+        self._key_width = -(-max(len(word) for word in encoded_words) // 8) * 8
+        self._candidates = np.zeros((256, 256, self._key_width + 1), dtype=bool)
+        for word in encoded_words:
+            self._candidates[word[0], word[-1], len(word)] = True
+        word_keys = self._pack_keys(np.array(
+            [list(word.ljust(self._key_width, b'\0')) for word in encoded_words], dtype=np.uint8
+        ))
+        order = np.argsort(word_keys['hash'], kind='stable')
+        self._word_keys = word_keys[order]
+        self._id_weights = np.array([self.weights.get(words[i], 0) for i in order], dtype=np.int64)
+        self._id_is_negation = np.array([words[i] in NEGATION_WORDS for i in order], dtype=bool)
+
+    def analyze(self, text: str) -> Dict:
+        """
+        Score a message
+
+        Returns:
+            Dict with 'sentiment' (positive, negative or neutral), 'score' (the
+            weight of the winning side), 'confidence' and per-side totals
+        """
+        positive, negative = self.scan(text.lower())
+        return self.result(positive, negative, len(text.split()))
+
+    def scan(self, text_lower: str) -> Tuple[int, int]:
+        """Positive and negative totals of lowercased text in one regex pass"""
+        positive = 0
+        negative = 0
+        negation_end = None
+        for match in self.pattern.finditer(text_lower):
+            word = match.group(0)
+            weight = self.weights.get(word)
+            if weight is not None:
+                if negation_end is not None and self._within_window(text_lower, negation_end, match.start()):
+                    weight = -weight
+                if weight > 0:
+                    positive += weight
+                else:
+                    negative -= weight
+            if word in NEGATION_WORDS:
+                negation_end = match.end()
+        return positive, negative
+
+    @staticmethod
+    def _within_window(text_lower: str, start: int, end: int) -> bool:
+        """Whether fewer than NEGATION_WINDOW tokens lie between two offsets"""
+        for count, _ in enumerate(WORD_PATTERN.finditer(text_lower, start, end), 1):
+            if count >= NEGATION_WINDOW:
+                return False
+        return True
+
+    def analyze_many(self, texts: Iterable[str], chunk_size: int = 100000) -> List[Dict]:
+        """
+        Score a batch of messages, e.g. when backfilling analytics
+
+        Returns:
+            List of the same dicts as analyze, in input order
+        """
+        results = []
+        texts = list(texts)
+        for start in range(0, len(texts), chunk_size):
+            positive, negative, _, word_counts = self.count_many(texts[start:start + chunk_size])
+            results.extend(
+                self.result(*counts)
+                for counts in zip(positive.tolist(), negative.tolist(), word_counts.tolist())
+            )
+        return results
+
+    def count_many(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Per-message positive totals, negative totals, negated sentiment words and word counts
+
+        The batch is joined into one byte buffer and tokenized with byte masks.
+        Tokens are mapped to lexicon IDs by packing their bytes into integer
+        keys, and negation windows and per-message totals are computed with
+        array operations and bincount instead of a Python loop per word.
+        """
+        message_count = len(texts)
+        if not message_count:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, empty
+        joined = BATCH_SEPARATOR.join(texts)
+        has_separator = joined.count(BATCH_SEPARATOR) != message_count - 1
+        if has_separator:
+            joined = BATCH_SEPARATOR.join(text.replace(BATCH_SEPARATOR, ' ') for text in texts)
+        joined_lower = joined.lower()
+        encoded = joined_lower.encode('utf-8')
+        size = len(encoded)
+        # A leading separator marks the start of the first message, and trailing
+        # padding ends the last token and lets keys be gathered past the end
+        data = np.frombuffer(b'\0' + encoded + b'\0' * self._key_width, dtype=np.uint8)
+        separators = np.flatnonzero(data[:size + 1] == 0)
+
+        # Tokens are maximal runs of token bytes; the separator byte is never one
+        is_token = TOKEN_BYTES[data]
+        edges = np.flatnonzero(is_token[1:] != is_token[:-1]) + 1
+        token_starts, token_ends = edges[0::2], edges[1::2]
+        lengths = token_ends - token_starts
+
+        # Only tokens that could be lexicon words are looked up; their index
+        # among all tokens is kept as the position for negation windows
+        candidates = np.flatnonzero(lengths <= self._key_width)
+        candidates = candidates[self._candidates[
+            data[token_starts[candidates]], data[token_ends[candidates] - 1], lengths[candidates]
+        ]]
+        offsets = np.arange(self._key_width)
+        token_bytes = data[token_starts[candidates, None] + offsets]
+        token_bytes[offsets >= lengths[candidates, None]] = 0
+        keys = self._pack_keys(token_bytes)
+        slots = np.minimum(np.searchsorted(self._word_keys['hash'], keys['hash']), len(self._word_keys) - 1)
+        found = np.ones(len(keys), dtype=bool)
+        for name in keys.dtype.names:
+            found &= self._word_keys[name][slots] == keys[name]
+
+        positions = candidates[found]
+        word_ids = slots[found]
+        messages = np.searchsorted(separators, token_starts[positions]) - 1
+        weights = self._id_weights[word_ids]
+        is_negation = self._id_is_negation[word_ids]
+
+        # A sentiment word is negated when the latest negation before it is in
+        # the same message and at most NEGATION_WINDOW tokens back
+        matches = np.arange(len(positions))
+        last_negation = np.maximum.accumulate(np.where(is_negation, matches, -1)) if len(matches) else matches
+        previous_negation = np.concatenate(([-1], last_negation))[:-1]
+        has_negation = previous_negation >= 0
+        negation = np.maximum(previous_negation, 0)
+        negated = (has_negation & (weights != 0)
+                   & (messages[negation] == messages)
+                   & (positions - positions[negation] <= NEGATION_WINDOW))
+        weights = np.where(negated, -weights, weights)
+
+        positive = np.bincount(messages, weights=np.maximum(weights, 0), minlength=message_count)
+        negative = np.bincount(messages, weights=np.maximum(-weights, 0), minlength=message_count)
+        negations = np.bincount(messages, weights=negated, minlength=message_count)
+
+        if size == len(joined_lower) and not has_separator:
+            # ASCII only: a word starts at every non-whitespace byte after whitespace or a separator
+            is_space = WHITESPACE_BYTES[data[:size + 1]] | (data[:size + 1] == 0)
+            word_starts = np.flatnonzero(~is_space[1:] & is_space[:-1]) + 1
+            boundaries = np.searchsorted(word_starts, np.append(separators, size + 1))
+            word_counts = np.diff(boundaries)
+        else:
+            word_counts = np.array([len(text.split()) for text in texts])
+
+        return (positive.astype(np.int64), negative.astype(np.int64),
+                negations.astype(np.int64), word_counts.astype(np.int64))
+
+    @staticmethod
+    def _pack_keys(token_bytes: np.ndarray) -> np.ndarray:
+        """Exact uint64 keys of zero-padded token bytes, plus a hash to sort and search on"""
+        words = np.ascontiguousarray(token_bytes).view('>u8')
+        names = [f'part{i}' for i in range(words.shape[1])]
+        keys = np.empty(len(words), dtype=[('hash', np.uint64)] + [(name, np.uint64) for name in names])
+        key_hash = np.zeros(len(words), dtype=np.uint64)
+        for i, name in enumerate(names):
+            keys[name] = words[:, i]
+            key_hash = key_hash * np.uint64(0x9E3779B97F4A7C15) + words[:, i]
+        keys['hash'] = key_hash
+        return keys
+
+    @staticmethod
+    def result(positive: int, negative: int, word_count: int) -> Dict:
+        """Turn side totals into the sentiment dict returned by analyze"""
+        if positive > negative:
+            sentiment, score = 'positive', positive
+        elif negative > positive:
+            sentiment, score = 'negative', negative
+        else:
+            sentiment, score = 'neutral', 0
+
+        confidence = min(0.9, score / max(word_count, 1) * 10) if score else 0.5
+        return {
+            'sentiment': sentiment,
+            'score': score,
+            'confidence': confidence,
+            'positive': positive,
+            'negative': negative
+        }
@@ -7,6 +7,13 @@ import unittest
 from unittest.mock import Mock, MagicMock, patch
 import sys
 import os
+import json
+import random
+import tempfile
+import time
+from datetime import datetime
+import langdetect
+from firebase_admin import firestore
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -14,12 +21,31 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from langchain_core.language_models.fake import FakeListLLM
 
 from empathibot import (
+    CrisisClassifier,
     CrisisDetector,
+    CrisisLexicon,
+    KeywordMatcher,
     LanguageHandler,
+    ProfileCache,
+    ResultCache,
+    RetrievalMemory,
+    RollingRiskTracker,
     UserSessionManager,
     ConversationMemory,
-    Empathibot
+    ConversationMemoryCache,
+    ConversationWindowCache,
+    ContextBuilder,
+    Empathibot,
+    MOOD_TREND_SIZE,
+    count_tokens,
+    mood_entry_key,
+    mood_trend_entries,
+    phone_index_key,
+    truncate_tokens
 )
+from benchmarks import find_regressions
+from mental_health_analyzer import MentalHealthAnalyzer
+from sentiment import SentimentAnalyzer
 
 
 class TestCrisisDetector(unittest.TestCase):
@@ -93,6 +119,89 @@ class TestCrisisDetector(unittest.TestCase):
         self.assertIsNotNone(result)
         self.assertIn('depressed', ' '.join(result['matched_keywords']))
 
+    def test_overlapping_keywords_all_counted(self):
+        """Test that keywords sharing words are each matched in the single pass"""
+        result = self.detector.detect_crisis("I cut myself and me quiero morir")
+
+        self.assertEqual(
+            result['matched_keywords'],
+            ['cut myself', 'quiero morir', 'me quiero morir', 'cut']
+        )
+        self.assertEqual(result['severity_score'], 350)
+
+    def test_keywords_require_word_boundaries(self):
+        """Test that keywords don't match inside longer words"""
+        result = self.detector.detect_crisis("The haircut was cute, no cutting involved")
+
+        self.assertEqual(result['matched_keywords'], [])
+
+    def test_negated_keyword_ignored(self):
+        """Test that negated keywords don't add to the score"""
+        result = self.detector.detect_crisis("I'm not depressed, just tired")
+
+        self.assertEqual(result['severity_score'], 0)
+        self.assertEqual(result['matched_keywords'], [])
+
+    def test_negation_window_is_three_words(self):
+        """Test that only the three words before a keyword can negate it"""
+        negated = self.detector.detect_crisis("I don't really feel hopeless")
+        self.assertEqual(negated['matched_keywords'], [])
+
+        not_negated = self.detector.detect_crisis("not that I am hopeless")
+        self.assertEqual(not_negated['matched_keywords'], ['hopeless'])
+
+    def test_long_message_negation(self):
+        """Test negation on a long message with many keyword hits"""
+        text = ("I am not hopeless. " * 200) + "I feel hopeless"
+        result = self.detector.detect_crisis(text)
+
+        self.assertEqual(result['matched_keywords'], ['hopeless'])
+        self.assertEqual(result['severity_score'], 50)
+
+    def test_detect_crisis_many_matches_single(self):
+        """Test that batch scoring returns the same dicts as detect_crisis"""
+        messages = [
+            "I want to kill myself",
+            "I'm not depressed",
+            "Therapy is really helping me",
+            "I feel hopeless and overwhelmed",
+            "",
+            "i want to KILL myself"
+        ]
+        expected = [self.detector.detect_crisis(msg) for msg in messages]
+
+        self.assertEqual(self.detector.detect_crisis_many(messages), expected)
+        self.assertEqual(
+            self.detector.detect_crisis_many(messages, processes=2, chunk_size=2),
+            expected
+        )
+
+    def test_detect_crisis_many_scores_repeats_once(self):
+        """Test that batch scoring dedupes messages and leaves the live latency stats alone"""
+        detector = CrisisDetector()
+        with patch.object(detector, '_score', wraps=detector._score) as score:
+            results = detector.detect_crisis_many(["ok", "OK", "I feel hopeless", "ok"])
+
+        self.assertEqual(score.call_count, 2)
+        self.assertEqual([result['severity'] for result in results], ['low', 'low', 'high', 'low'])
+        results[0]['matched_keywords'].append('annotated')
+        self.assertEqual(results[1]['matched_keywords'], [])
+        self.assertEqual(detector.get_latency_stats()['lexicon']['count'], 0)
+
+    def test_every_language_scanned(self):
+        """Test that crisis and positive keywords of every language count for any message"""
+        for message, severity in [("sin esperanza", 'high'), ("no puedo mas", 'high'),
+                                  ("je suis sans espoir", 'high'), ("quiero morir, I want to die", 'critical')]:
+            self.assertEqual(self.detector.detect_crisis(message)['severity'], severity, f"Missed '{message}'")
+        self.assertEqual(self.detector.detect_crisis("Estoy desesperado, but grateful")['severity_score'], 40)
+
+    def test_keywords_sharing_a_prefix(self):
+        """Test that the trie-compiled matcher finds the right keyword among ones sharing letters"""
+        matcher = KeywordMatcher(['cut', 'cutting', 'cut myself', 'cure'], ['cute'])
+
+        self.assertEqual(matcher.scan("cutting, cut  myself, cured"), ([(0, 9), (1, 0), (2, 9)], []))
+        self.assertEqual(matcher.scan("a cute cure"), ([(3, 7)], [0]))
+
     def test_crisis_response_generation(self):
         """Test that appropriate crisis responses are generated"""
         # Critical response
@@ -113,6 +222,466 @@ class TestCrisisDetector(unittest.TestCase):
         self.assertIsNone(low_response)
 
 
+class TestCrisisLexicon(unittest.TestCase):
+    """Test the versioned, hot-reloadable crisis lexicon"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.lexicon_path = os.path.join(self.temp_dir.name, 'lexicon.json')
+        self.write_lexicon('1', [
+            {'keyword': 'hopeless', 'tier': 'high', 'weight': 50, 'language': 'en'},
+            {'keyword': 'therapy', 'tier': 'positive', 'weight': -10, 'language': 'en'}
+        ])
+        self.detector = CrisisDetector(lexicon_path=self.lexicon_path)
+
+    def tearDown(self):
+        self.detector.stop_lexicon_watcher()
+        self.temp_dir.cleanup()
+
+    def write_lexicon(self, version, keywords):
+        with open(self.lexicon_path, 'w', encoding='utf-8') as lexicon_file:
+            json.dump({'version': version, 'keywords': keywords}, lexicon_file)
+
+    def test_default_lexicon_loads(self):
+        """Test that the bundled lexicon has every tier"""
+        detector = CrisisDetector()
+        for tier in CrisisLexicon.TIERS:
+            self.assertTrue(detector.lexicon.keywords_for(tier), f"No keywords for tier {tier}")
+
+    def test_result_records_lexicon_version(self):
+        """Test that results carry the version of the lexicon that scored them"""
+        result = self.detector.detect_crisis("I feel hopeless")
+
+        self.assertEqual(result['severity_score'], 50)
+        self.assertEqual(result['lexicon_version'], '1')
+
+    def test_reload_swaps_new_version(self):
+        """Test that a new lexicon version is compiled and swapped in"""
+        self.write_lexicon('2', [
+            {'keyword': 'hopeless', 'tier': 'high', 'weight': 50, 'language': 'en'},
+            {'keyword': 'no way out', 'tier': 'critical', 'weight': 100, 'language': 'en'}
+        ])
+
+        self.assertTrue(self.detector.reload_lexicon())
+        result = self.detector.detect_crisis("There is no way out, I feel hopeless")
+
+        self.assertEqual(result['matched_keywords'], ['no way out', 'hopeless'])
+        self.assertEqual(result['lexicon_version'], '2')
+
+    def test_reload_invalidates_cached_results(self):
+        """Test that a cached result is not reused after the lexicon changes"""
+        self.assertFalse(self.detector.detect_crisis("no way out")['is_crisis'])
+        self.write_lexicon('2', [{'keyword': 'no way out', 'tier': 'critical'}])
+
+        self.assertTrue(self.detector.reload_lexicon())
+        result = self.detector.detect_crisis("no way out")
+
+        self.assertTrue(result['is_crisis'])
+        self.assertEqual(self.detector.get_cache_stats()['hits'], 0)
+
+    def test_reload_same_version_is_noop(self):
+        """Test that reloading an unchanged version keeps the current lexicon"""
+        lexicon = self.detector.lexicon
+
+        self.assertFalse(self.detector.reload_lexicon())
+        self.assertIs(self.detector.lexicon, lexicon)
+
+    def test_invalid_tier_rejected(self):
+        """Test that unknown tiers fail loudly instead of being ignored"""
+        with self.assertRaises(ValueError):
+            CrisisLexicon([{'keyword': 'sad', 'tier': 'mild'}], version='bad')
+
+    def test_watcher_reloads_changed_file(self):
+        """Test that the background watcher picks up a changed lexicon file"""
+        self.detector.start_lexicon_watcher(interval_seconds=0.05)
+        self.write_lexicon('2', [{'keyword': 'no way out', 'tier': 'critical'}])
+        os.utime(self.lexicon_path, (time.time() + 5, time.time() + 5))
+
+        deadline = time.time() + 5
+        while self.detector.lexicon.version != '2' and time.time() < deadline:
+            time.sleep(0.05)
+
+        self.assertEqual(self.detector.lexicon.version, '2')
+        self.assertTrue(self.detector.detect_crisis("no way out")['is_crisis'])
+
+
+class TestResultCache(unittest.TestCase):
+    """Test memoized crisis and sentiment results"""
+
+    def test_repeated_message_hits_cache(self):
+        """Test that a repeated normalized message skips the scan with the same result"""
+        detector = CrisisDetector()
+        first = detector.detect_crisis("I feel hopeless")
+        second = detector.detect_crisis("I FEEL HOPELESS")
+
+        self.assertEqual(first, second)
+        self.assertEqual(detector.get_latency_stats()['lexicon']['count'], 1)
+        stats = detector.get_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_cached_result_is_a_copy(self):
+        """Test that annotating a returned result does not change the cached one"""
+        detector = CrisisDetector()
+        result = detector.detect_crisis("I feel hopeless")
+        result['severity'] = 'critical'
+        result['matched_keywords'].append('changed')
+
+        cached = detector.detect_crisis("I feel hopeless")
+        self.assertEqual(cached['severity'], 'high')
+        self.assertEqual(cached['matched_keywords'], ['hopeless'])
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted at capacity"""
+        cache = ResultCache(max_size=2)
+        for text in ['hi', 'ok', 'hi', 'thanks']:
+            key = ResultCache.make_key(text)
+            if cache.get(key) is None:
+                cache.put(key, {'text': text})
+
+        self.assertIsNotNone(cache.get(ResultCache.make_key('hi')))
+        self.assertIsNone(cache.get(ResultCache.make_key('ok')))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_zero_size_disables_cache(self):
+        """Test that a zero-size cache always scores again"""
+        detector = CrisisDetector(cache_size=0)
+        detector.detect_crisis("ok")
+        detector.detect_crisis("ok")
+
+        self.assertEqual(detector.get_latency_stats()['lexicon']['count'], 2)
+        self.assertEqual(detector.get_cache_stats()['size'], 0)
+
+
+class TestProfileCache(unittest.TestCase):
+    """Test the LRU+TTL user profile cache"""
+
+    def test_lookup_by_id_and_phone(self):
+        """Test that a cached profile is found by user ID and by phone number"""
+        cache = ProfileCache()
+        cache.put('user1', {'id': 'user1', 'phone_number': 'whatsapp:+1'})
+
+        self.assertEqual(cache.get('user1')['phone_number'], 'whatsapp:+1')
+        self.assertEqual(cache.get_by_phone('whatsapp:+1')['id'], 'user1')
+        self.assertIsNone(cache.get_by_phone('whatsapp:+2'))
+        self.assertEqual(cache.stats()['hit_rate'], 2 / 3)
+
+    def test_ttl_expiry(self):
+        """Test that profiles older than the TTL are read again"""
+        cache = ProfileCache(ttl_seconds=60)
+        with patch('empathibot.time.monotonic', return_value=1000.0):
+            cache.put('user1', {'phone_number': 'whatsapp:+1'})
+        with patch('empathibot.time.monotonic', return_value=1061.0):
+            self.assertIsNone(cache.get('user1'))
+            self.assertIsNone(cache.get_by_phone('whatsapp:+1'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used profile and its phone entry are evicted"""
+        cache = ProfileCache(max_size=2)
+        cache.put('a', {'phone_number': '1'})
+        cache.put('b', {'phone_number': '2'})
+        cache.get('a')
+        cache.put('c', {'phone_number': '3'})
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNone(cache.get_by_phone('2'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_update_applies_firestore_fields(self):
+        """Test that write-through updates follow Firestore field semantics"""
+        cache = ProfileCache()
+        cache.put('user1', {
+            'conversation_count': 4, 'mental_health_data': {'risk_level': 'low', 'mood_trend': []}
+        })
+        cache.update('user1', {
+            'conversation_count': firestore.Increment(1),
+            'crisis_alerts': firestore.Increment(1),
+            'mental_health_data.risk_level': 'high',
+            'mental_health_data.mood_trend': firestore.DELETE_FIELD,
+            'last_interaction': firestore.SERVER_TIMESTAMP
+        })
+
+        profile = cache.get('user1')
+        self.assertEqual(profile['conversation_count'], 5)
+        self.assertEqual(profile['crisis_alerts'], 1)
+        self.assertEqual(profile['mental_health_data'], {'risk_level': 'high'})
+        self.assertIsInstance(profile['last_interaction'], datetime)
+
+    def test_returned_profile_is_a_copy(self):
+        """Test that changing a returned profile does not change the cached one"""
+        cache = ProfileCache()
+        cache.put('user1', {'mental_health_data': {'mood_trend': []}})
+        cache.get('user1')['mental_health_data']['mood_trend'].append('sad')
+
+        self.assertEqual(cache.get('user1')['mental_health_data']['mood_trend'], [])
+
+
+class TestConversationWindowCache(unittest.TestCase):
+    """Test the per-user recent message cache"""
+
+    def test_append_after_seed(self):
+        """Test that saved messages extend a seeded window, keeping only the newest"""
+        cache = ConversationWindowCache(window=3)
+        cache.seed('user1', [{'user_message': str(i)} for i in range(5)])
+        cache.append('user1', {'user_message': '5'})
+
+        self.assertEqual([m['user_message'] for m in cache.get('user1', 3)], ['3', '4', '5'])
+        self.assertEqual([m['user_message'] for m in cache.get('user1', 2)], ['4', '5'])
+        self.assertIsNone(cache.get('user1', 4))
+
+    def test_append_to_uncached_user_is_ignored(self):
+        """Test that an unseeded user stays a miss so the next read goes to Firestore"""
+        cache = ConversationWindowCache()
+        cache.append('user1', {'user_message': 'hi'})
+        self.assertIsNone(cache.get('user1', 5))
+
+    def test_byte_cap_per_user(self):
+        """Test that the oldest messages are dropped once a user's text is over the byte cap"""
+        cache = ConversationWindowCache(max_bytes_per_user=10)
+        cache.seed('user1', [{'user_message': 'aaaa', 'bot_response': 'bb'}])
+        cache.append('user1', {'user_message': 'cccc', 'bot_response': 'dd'})
+
+        self.assertEqual([m['user_message'] for m in cache.get('user1', 10)], ['cccc'])
+        self.assertEqual(cache.stats()['bytes'], 6)
+
+    def test_user_lru_eviction(self):
+        """Test that the least recently used user is evicted at capacity"""
+        cache = ConversationWindowCache(max_users=1)
+        cache.seed('user1', [])
+        cache.seed('user2', [])
+
+        self.assertIsNone(cache.get('user1', 5))
+        self.assertEqual(cache.get('user2', 5), [])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class TestFuzzyCrisisMatching(unittest.TestCase):
+    """Test typo and obfuscation tolerant crisis matching"""
+
+    def setUp(self):
+        self.detector = CrisisDetector(fuzzy=True)
+
+    def test_typos_leetspeak_and_slang_detected(self):
+        """Test that obfuscated critical phrases are caught"""
+        for msg in ["I want to suicde", "k1ll myself", "i wanna die"]:
+            result = self.detector.detect_crisis(msg)
+            self.assertEqual(result['severity'], 'critical', f"Missed fuzzy match in: {msg}")
+
+    def test_accents_folded(self):
+        """Test that accented spellings match the unaccented lexicon"""
+        result = self.detector.detect_crisis("no puedo más")
+        self.assertEqual(result['matched_keywords'], ['no puedo mas'])
+
+    def test_corrections_reported(self):
+        """Test that applied corrections are listed in the result"""
+        result = self.detector.detect_crisis("I feel hopless")
+
+        self.assertEqual(result['matched_keywords'], ['hopeless'])
+        self.assertEqual(
+            result['fuzzy_corrections'],
+            [{'original': 'hopless', 'corrected': 'hopeless'}]
+        )
+
+    def test_everyday_words_not_corrected(self):
+        """Test that substitutions of common words are not turned into crisis terms"""
+        for msg in ["I am homeless right now", "I keep putting it off", "I'm closing the shop"]:
+            result = self.detector.detect_crisis(msg)
+            self.assertEqual(result['matched_keywords'], [], f"False positive for: {msg}")
+
+    def test_inflections_not_corrected(self):
+        """Test that plurals and past tenses of lexicon words are not rewritten onto them"""
+        for msg in ["I overdosed on coffee", "the suicides in the news", "the cuttings from the garden"]:
+            result = self.detector.detect_crisis(msg)
+            self.assertEqual(result['fuzzy_corrections'], [], f"Rewrote an inflection in: {msg}")
+            self.assertEqual(result['severity'], 'low', f"False positive for: {msg}")
+        # An extra letter elsewhere in the word is still a typo
+        self.assertEqual(self.detector.detect_crisis("I want to suiccide")['severity'], 'critical')
+
+    def test_exact_mode_unchanged(self):
+        """Test that fuzzy matching is off by default"""
+        result = CrisisDetector(fuzzy=False).detect_crisis("I want to suicde")
+
+        self.assertEqual(result['matched_keywords'], [])
+        self.assertEqual(result['fuzzy_corrections'], [])
+
+    def test_budget_exhausted_falls_back_to_exact(self):
+        """Test that no corrections are made once the time budget is spent"""
+        detector = CrisisDetector(fuzzy=True, fuzzy_budget_ms=0)
+        result = detector.detect_crisis("I want to suicde but I want to die")
+
+        self.assertEqual(result['fuzzy_corrections'], [])
+        self.assertEqual(result['matched_keywords'], ['want to die'])
+        self.assertTrue(result['fuzzy_budget_exhausted'])
+
+    def test_long_message_of_unseen_words(self):
+        """Test that a typo at the end of a long message of new words is still corrected"""
+        rng = random.Random(7)
+        rant = ' '.join(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10)))
+                        for _ in range(800))
+        # The latency of this is gated by benchmarks.py; a loaded test machine shouldn't fail it here
+        detector = CrisisDetector(fuzzy=True, fuzzy_budget_ms=1000)
+        result = detector.detect_crisis(rant + " i want to suicde")
+
+        self.assertFalse(result['fuzzy_budget_exhausted'])
+        self.assertIn({'original': 'suicde', 'corrected': 'suicide'}, result['fuzzy_corrections'])
+        self.assertEqual(result['severity'], 'critical')
+
+
+class TestCrisisCascade(unittest.TestCase):
+    """Test the lexicon + classifier crisis detection cascade"""
+
+    def setUp(self):
+        texts = [
+            "I feel anxious and nobody would miss me",
+            "so overwhelmed, nobody would miss me anyway",
+            "I feel anxious about my exam tomorrow",
+            "overwhelmed with work but the weekend is close"
+        ] * 5
+        labels = [1, 1, 0, 0] * 5
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.classifier_path = os.path.join(self.temp_dir.name, 'classifier.npz')
+        CrisisClassifier.train(texts, labels, n_features=2 ** 12).save(self.classifier_path)
+        self.detector = CrisisDetector(classifier_path=self.classifier_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_classifier_round_trip(self):
+        """Test that saved weights load back to the same predictions"""
+        classifier = CrisisClassifier.load(self.classifier_path)
+        score = classifier.predict("nobody would miss me")
+
+        self.assertEqual(score, self.detector.classifier.predict("nobody would miss me"))
+        self.assertGreater(score, 0.5)
+
+    def test_ambiguous_band_escalated_by_model(self):
+        """Test that a high model score escalates an ambiguous lexicon score"""
+        result = self.detector.detect_crisis("I feel anxious and nobody would miss me")
+
+        self.assertEqual(result['severity_score'], 20)
+        self.assertGreater(result['model_score'], 0.5)
+        self.assertTrue(result['is_crisis'])
+        self.assertEqual(result['severity'], 'high')
+
+    def test_low_model_score_keeps_lexicon_result(self):
+        """Test that the model never downgrades the lexicon severity"""
+        result = self.detector.detect_crisis("I feel anxious about my exam tomorrow")
+
+        self.assertLess(result['model_score'], 0.5)
+        self.assertEqual(result['severity'], 'moderate')
+        self.assertFalse(result['is_crisis'])
+
+    def test_classifier_skipped_outside_band(self):
+        """Test that clear-cut messages only pay for the lexicon stage"""
+        for msg in ["Hello there", "I want to kill myself"]:
+            self.assertIsNone(self.detector.detect_crisis(msg)['model_score'])
+
+        stats = self.detector.get_latency_stats()
+        self.assertEqual(stats['lexicon']['count'], 2)
+        self.assertEqual(stats['classifier']['count'], 0)
+
+    def test_no_classifier_by_default(self):
+        """Test that the cascade is off without a classifier file"""
+        result = CrisisDetector().detect_crisis("I feel anxious")
+        self.assertIsNone(result['model_score'])
+
+
+class TestRollingRiskTracker(unittest.TestCase):
+    """Test the decayed conversation-level crisis score"""
+
+    def setUp(self):
+        self.tracker = RollingRiskTracker(threshold=90, half_life_hours=6)
+
+    def test_scores_accumulate(self):
+        """Test that consecutive moderate messages add up"""
+        state = None
+        for _ in range(5):
+            state = self.tracker.update(state, 20, now=1000.0)
+
+        self.assertEqual(state['score'], 100)
+        self.assertTrue(self.tracker.is_escalated(state))
+
+    def test_score_decays_by_half_life(self):
+        """Test that the previous score halves once per half-life"""
+        state = {'score': 80.0, 'updated_at': 0.0}
+        updated = self.tracker.update(state, 0, now=6 * 3600)
+
+        self.assertAlmostEqual(updated['score'], 40.0)
+        self.assertFalse(self.tracker.is_escalated(updated))
+
+    def test_reset(self):
+        """Test that reset starts the score over"""
+        self.assertEqual(self.tracker.reset(now=5.0), {'score': 0.0, 'updated_at': 5.0})
+
+
+class TestBenchmarkGates(unittest.TestCase):
+    """Test the benchmark regression gate"""
+
+    def test_slowdown_above_threshold_regresses(self):
+        """Test that a case slower than the threshold is reported"""
+        baseline = {'detect_crisis/en/1000/0.0': {'p50_ms': 1.0, 'p99_ms': 2.0}}
+        results = {'detect_crisis/en/1000/0.0': {'p50_ms': 1.6, 'p99_ms': 2.1}}
+
+        regressions = find_regressions(results, baseline, threshold=0.5)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('p50_ms', regressions[0])
+
+    def test_noise_floor(self):
+        """Test that tiny differences do not regress"""
+        baseline = {'detect_crisis/en/10/0.0': {'p50_ms': 0.01, 'p99_ms': 0.02}}
+        results = {'detect_crisis/en/10/0.0': {'p50_ms': 0.03, 'p99_ms': 0.05}}
+
+        self.assertEqual(find_regressions(results, baseline, threshold=0.5), [])
+
+
+class TestSentimentAnalyzer(unittest.TestCase):
+    """Test the shared sentiment lexicon"""
+
+    def setUp(self):
+        self.analyzer = SentimentAnalyzer()
+
+    def test_whole_words_only(self):
+        """Test that sentiment words don't match inside other words"""
+        result = self.analyzer.analyze("Goodbye, I saddled the horse")
+        self.assertEqual(result['sentiment'], 'neutral')
+
+    def test_negation_flips_polarity(self):
+        """Test that a preceding negation counts a word for the opposite side"""
+        self.assertEqual(self.analyzer.analyze("I am not happy")['sentiment'], 'negative')
+        self.assertEqual(self.analyzer.analyze("It wasn't that bad really")['sentiment'], 'positive')
+        self.assertEqual(self.analyzer.analyze("No, today I feel happy")['sentiment'], 'positive')
+
+    def test_weights(self):
+        """Test that strong words outweigh mild ones"""
+        result = self.analyzer.analyze("A bit sad but the day was amazing")
+        self.assertEqual((result['positive'], result['negative']), (2, 1))
+        self.assertEqual(result['score'], 2)
+
+    def test_bot_and_assessment_agree(self):
+        """Test that the WhatsApp bot and the web assessment score text the same way"""
+        empathibot = Empathibot(db=Mock(), llm=FakeListLLM(responses=["ok"]))
+        text = "I'm not good, just worried and scared"
+
+        self.assertEqual(empathibot._analyze_sentiment(text), MentalHealthAnalyzer().analyze_text_sentiment(text))
+
+    def test_batch_matches_per_message(self):
+        """Test that batch scoring gives the same result as scoring each message"""
+        texts = [
+            "I am not happy", "It wasn't that bad really", "Goodbye, I saddled the horse",
+            "", "Amazing! Just AMAZING", "No, today I feel happy", "Café was great, merci",
+            "don't\x00 worry, sad", "I'm not good, just worried and scared",
+        ]
+        self.assertEqual(self.analyzer.analyze_many(texts, chunk_size=4),
+                         [self.analyzer.analyze(text) for text in texts])
+
+    def test_batch_negation_stays_in_message(self):
+        """Test that a negation at the end of one message doesn't flip the next one"""
+        results = self.analyzer.analyze_many(["I said no", "happy today"])
+        self.assertEqual(results[1]['sentiment'], 'positive')
+
+
 class TestLanguageHandler(unittest.TestCase):
     """Test the Multilingual Language Handler"""
 
@@ -153,6 +722,65 @@ class TestLanguageHandler(unittest.TestCase):
         # Should either detect en or fallback to en
         self.assertIsNotNone(lang)
 
+    def test_script_tier(self):
+        """Test that non-Latin scripts are decided without langdetect"""
+        cases = {
+            "مرحبا كيف حالك اليوم": 'ar',
+            "नमस्ते आप कैसे हैं": 'hi',
+            "今日はとても悲しいです": 'ja',
+            "我今天很难过": 'zh-cn'
+        }
+        with patch('empathibot.langdetect.detect_langs') as mock_detect:
+            for text, expected in cases.items():
+                self.assertEqual(self.handler.detect(text), {'language': expected, 'tier': 'script'})
+            mock_detect.assert_not_called()
+
+    def test_short_message_keeps_preferred_language(self):
+        """Test that short and emoji-only messages keep the user's language"""
+        for text in ["ok", "😢😢", "gracias"]:
+            self.assertEqual(self.handler.detect(text, preferred_language='es'),
+                             {'language': 'es', 'tier': 'short'})
+        self.assertEqual(self.handler.detect("ok")['language'], 'en')
+
+    def test_latin_text_uses_langdetect(self):
+        """Test that longer Latin-script text goes to the seeded langdetect tier"""
+        result = self.handler.detect("Bonjour, je me sens très triste aujourd'hui")
+
+        self.assertEqual(result, {'language': 'fr', 'tier': 'langdetect'})
+        self.assertEqual(self.handler.get_tier_stats(), {'langdetect': 1})
+
+    def test_confident_profile_skips_detection(self):
+        """Test that an established language is reused until the next re-check"""
+        handler = LanguageHandler(recheck_every=2)
+        profile = {'distribution': {'es': 0.95}, 'messages': 5, 'since_check': 0, 'script': 'latin'}
+
+        with patch('empathibot.langdetect.detect_langs', wraps=langdetect.detect_langs) as mock_detect:
+            tiers = []
+            for _ in range(3):
+                result, profile = handler.detect_for_user("I think it will be alright tomorrow", profile)
+                tiers.append(result['tier'])
+
+        self.assertEqual(tiers, ['sticky', 'sticky', 'langdetect'])
+        self.assertEqual(mock_detect.call_count, 1)
+        self.assertEqual(profile['since_check'], 0)
+
+    def test_one_misdetection_does_not_flip_language(self):
+        """Test that a single other-language message doesn't change the user's language"""
+        profile = {'distribution': {'en': 0.7}, 'messages': 3, 'since_check': 0, 'script': 'latin'}
+        result, profile = self.handler.detect_for_user("Me siento muy triste hoy, no sé qué hacer", profile)
+
+        self.assertEqual(result['language'], 'en')
+        self.assertIn('es', profile['distribution'])
+
+    def test_script_change_resets_profile(self):
+        """Test that a message in another script is detected and starts a new distribution"""
+        profile = {'distribution': {'en': 1.0}, 'messages': 10, 'since_check': 0, 'script': 'latin'}
+        result, profile = self.handler.detect_for_user("مرحبا كيف حالك اليوم", profile)
+
+        self.assertEqual(result, {'language': 'ar', 'tier': 'script'})
+        self.assertEqual(profile['distribution'], {'ar': 1.0})
+        self.assertEqual(profile['messages'], 1)
+
 
 class TestUserSessionManager(unittest.TestCase):
     """Test the User Session Management System"""
@@ -162,54 +790,197 @@ class TestUserSessionManager(unittest.TestCase):
         self.mock_db = Mock()
         self.session_manager = UserSessionManager(self.mock_db)
 
+    def _mock_collections(self, index_user_id=None, legacy_users=()):
+        """Mock the users and phone index collections, returning them"""
+        users = Mock()
+        users.where.return_value.limit.return_value.stream.return_value = list(legacy_users)
+        index = Mock()
+        index_doc = index.document.return_value.get.return_value
+        index_doc.exists = index_user_id is not None
+        index_doc.to_dict.return_value = {'user_id': index_user_id}
+        collections = {'whatsapp_users': users, 'phone_index': index}
+        self.mock_db.collection.side_effect = collections.__getitem__
+        self.mock_db.transaction.return_value = Mock(_max_attempts=1, _read_only=False)
+        return users, index
+
     def test_create_new_user(self):
         """Test creating a new user profile"""
         phone = "whatsapp:+1234567890"
-
-        # Mock no existing users
-        mock_collection = Mock()
-        mock_query = Mock()
-        mock_query.stream.return_value = []
-        mock_collection.where.return_value.limit.return_value = mock_query
-
-        mock_doc = Mock()
-        mock_doc.id = "user123"
-        mock_collection.document.return_value = mock_doc
-
-        self.mock_db.collection.return_value = mock_collection
+        users, index = self._mock_collections()
+        users.document.return_value.id = "user123"
 
         user = self.session_manager.get_or_create_user(phone)
 
-        # Verify user was created
+        # Verify user and its index entry were created in the transaction
+        self.assertEqual(user['id'], 'user123')
         self.assertEqual(user['phone_number'], phone)
         self.assertTrue(user['check_in_enabled'])
+        transaction = self.mock_db.transaction.return_value
+        transaction.set.assert_any_call(index.document.return_value, {'user_id': 'user123'})
+        index.document.assert_called_with(phone_index_key(phone))
 
     def test_get_existing_user(self):
         """Test retrieving an existing user"""
         phone = "whatsapp:+1234567890"
-
-        # Mock existing user
-        mock_doc = Mock()
-        mock_doc.id = "user123"
-        mock_doc.to_dict.return_value = {
+        users, _ = self._mock_collections(index_user_id='user123')
+        users.document.return_value.get.return_value.to_dict.return_value = {
             'phone_number': phone,
             'conversation_count': 5,
             'check_in_enabled': True
         }
 
-        mock_collection = Mock()
-        mock_query = Mock()
-        mock_query.stream.return_value = [mock_doc]
-        mock_collection.where.return_value.limit.return_value = mock_query
-
-        self.mock_db.collection.return_value = mock_collection
-
         user = self.session_manager.get_or_create_user(phone)
 
-        # Verify correct user was retrieved
+        # Verify correct user was retrieved by direct gets, without a query
         self.assertEqual(user['id'], 'user123')
         self.assertEqual(user['phone_number'], phone)
         self.assertEqual(user['conversation_count'], 5)
+        users.document.assert_called_with('user123')
+        users.where.assert_not_called()
+        self.mock_db.transaction.assert_not_called()
+
+    def test_legacy_user_indexed(self):
+        """Test that a user missing from the phone index is found once by query and indexed"""
+        legacy_doc = Mock()
+        legacy_doc.id = 'legacy1'
+        _, index = self._mock_collections(legacy_users=[legacy_doc])
+
+        self.assertEqual(self.session_manager.resolve_user_id("whatsapp:+15550001"), 'legacy1')
+        index.document.return_value.set.assert_called_once_with({'user_id': 'legacy1'})
+
+    def test_unknown_number(self):
+        """Test that an unknown number resolves to no user"""
+        self._mock_collections()
+        self.assertIsNone(self.session_manager.resolve_user_id("whatsapp:+15550002"))
+
+    def test_concurrent_create_reuses_user(self):
+        """Test that a user created by a concurrent message is returned instead of a duplicate"""
+        phone = "whatsapp:+1234567890"
+        users, index = self._mock_collections()
+        index_ref = index.document.return_value
+        # The transactional read sees the index entry written by the other message
+        existing = Mock(exists=True)
+        existing.to_dict.return_value = {'user_id': 'other'}
+        index_ref.get.side_effect = lambda transaction=None: existing if transaction else Mock(exists=False)
+        users.where.return_value.limit.return_value.stream.return_value = []
+        users.document.return_value.get.return_value.to_dict.return_value = {'phone_number': phone}
+
+        user = self.session_manager.get_or_create_user(phone)
+
+        self.assertEqual(user['id'], 'other')
+        self.mock_db.transaction.return_value.set.assert_not_called()
+
+    def test_cached_user_skips_firestore(self):
+        """Test that repeat messages from a user are served from the session cache"""
+        phone = "whatsapp:+1234567890"
+        users, index = self._mock_collections(index_user_id='user123')
+        users.document.return_value.get.return_value.to_dict.return_value = {
+            'phone_number': phone, 'conversation_count': 5
+        }
+
+        self.session_manager.get_or_create_user(phone)
+        user = self.session_manager.get_or_create_user(phone)
+
+        self.assertEqual(user['conversation_count'], 5)
+        self.assertEqual(index.document.return_value.get.call_count, 1)
+        self.assertEqual(users.document.return_value.get.call_count, 1)
+        self.assertEqual(self.session_manager.sessions.stats()['hits'], 1)
+
+    def test_fresh_read_skips_only_the_phone_index(self):
+        """Test that a fresh read of a cached user re-reads the profile without counting a cache hit"""
+        phone = "whatsapp:+1234567890"
+        users, index = self._mock_collections(index_user_id='user123')
+        users.document.return_value.get.return_value.to_dict.return_value = {
+            'phone_number': phone, 'conversation_count': 5
+        }
+        self.session_manager.get_or_create_user(phone)
+        users.document.return_value.get.return_value.to_dict.return_value = {
+            'phone_number': phone, 'conversation_count': 9
+        }
+
+        user = self.session_manager.get_or_create_user(phone, fresh=True)
+
+        self.assertEqual(user['conversation_count'], 9)
+        self.assertEqual(index.document.return_value.get.call_count, 1)
+        self.assertEqual(users.document.return_value.get.call_count, 2)
+        self.assertEqual(self.session_manager.sessions.stats()['hits'], 0)
+        self.assertEqual(self.session_manager.sessions.get('user123')['conversation_count'], 9)
+
+    def test_update_writes_through(self):
+        """Test that activity updates reach both Firestore and the cached profile"""
+        phone = "whatsapp:+1234567890"
+        users, _ = self._mock_collections(index_user_id='user123')
+        users.document.return_value.get.return_value.to_dict.return_value = {
+            'phone_number': phone, 'conversation_count': 5
+        }
+        self.session_manager.get_or_create_user(phone)
+
+        self.session_manager.update_user_activity('user123', language='es', crisis_detected=True)
+
+        users.document.return_value.update.assert_called_once()
+        user = self.session_manager.get_or_create_user(phone)
+        self.assertEqual(user['conversation_count'], 6)
+        self.assertEqual(user['preferred_language'], 'es')
+        self.assertEqual(user['mental_health_data']['risk_level'], 'high')
+
+    def test_save_skips_trim_below_slack(self):
+        """Test that saving a message doesn't query the history until it is over max_history plus slack"""
+        users, _ = self._mock_collections()
+        messages = Mock()
+        self.mock_db.collection.side_effect = {
+            'whatsapp_users': users, 'whatsapp_messages': messages
+        }.__getitem__
+        self.session_manager.sessions.put('user123', {'history_count': 60})
+
+        self.session_manager.save_conversation('user123', "hi", "hello", {}, {}, 'en')
+
+        messages.add.assert_called_once()
+        messages.where.assert_not_called()
+        self.assertEqual(self.session_manager.sessions.get('user123')['history_count'], 61)
+
+    def test_trim_deletes_in_batches(self):
+        """Test that the history is trimmed with batched deletes once it is over the slack"""
+        manager = UserSessionManager(self.mock_db, max_history=2, trim_slack=1)
+        users, _ = self._mock_collections()
+        messages = Mock()
+        self.mock_db.collection.side_effect = {
+            'whatsapp_users': users, 'whatsapp_messages': messages
+        }.__getitem__
+        recent = [Mock(), Mock()]
+        old = [Mock(), Mock()]
+        messages.where.return_value.order_by.return_value.limit.return_value.stream.return_value = recent
+        messages.where.return_value.order_by.return_value.start_after.return_value.stream.return_value = old
+        manager.sessions.put('user123', {'history_count': 3})
+
+        manager.save_conversation('user123', "hi", "hello", {}, {}, 'en')
+
+        batch = self.mock_db.batch.return_value
+        self.assertEqual(batch.delete.call_count, 2)
+        batch.commit.assert_called_once()
+        self.assertEqual(manager.sessions.get('user123')['history_count'], 2)
+
+    def test_history_read_once_then_cached(self):
+        """Test that conversation history is queried on a miss and then served from the window cache"""
+        messages = Mock()
+        self.mock_db.collection.return_value = messages
+        stored = Mock()
+        stored.to_dict.return_value = {'user_message': 'hi', 'bot_response': 'hello'}
+        messages.where.return_value.order_by.return_value.limit.return_value.stream.return_value = [stored]
+        self.session_manager.sessions.put('user123', {'history_count': 1})
+
+        self.session_manager.get_conversation_history('user123')
+        self.session_manager.save_conversation('user123', "how are you", "good", {}, {}, 'en')
+        history = self.session_manager.get_conversation_history('user123')
+
+        self.assertEqual([m['user_message'] for m in history], ['hi', 'how are you'])
+        self.assertEqual(messages.where.call_count, 1)
+
+    def test_phone_index_key(self):
+        """Test that index keys are deterministic and don't contain the number"""
+        key = phone_index_key("whatsapp:+1234567890")
+        self.assertEqual(key, phone_index_key("whatsapp:+1234567890"))
+        self.assertNotEqual(key, phone_index_key("whatsapp:+1234567891"))
+        self.assertNotIn("1234567890", key)
 
     def test_update_user_activity(self):
         """Test updating user activity"""
@@ -261,6 +1032,127 @@ class TestConversationMemory(unittest.TestCase):
         self.assertIsNotNone(memory.memory)
 
 
+    def test_add_exchange_matches_rebuilt_memory(self):
+        """Test that an incrementally updated memory equals one rebuilt from the history"""
+        history = [{'user_message': f'Message {i}', 'bot_response': f'Response {i}'} for i in range(6)]
+        memory = ConversationMemory(user_id="user123", conversation_history=history[:5])
+        memory.add_exchange('Message 5', 'Response 5')
+
+        rebuilt = ConversationMemory(user_id="user123", conversation_history=history)
+        self.assertEqual(memory.get_context_summary(), rebuilt.get_context_summary())
+        self.assertEqual(len(memory.memory.chat_memory.messages), 10)
+
+    def test_memory_cache_lru(self):
+        """Test that live memories are reused and evicted least recently used first"""
+        cache = ConversationMemoryCache(max_size=1)
+        memory = ConversationMemory(user_id="user1")
+        cache.put('user1', memory)
+        self.assertIs(cache.get('user1'), memory)
+
+        cache.put('user2', ConversationMemory(user_id="user2"))
+        self.assertIsNone(cache.get('user1'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class TestContextBuilder(unittest.TestCase):
+    """Test the token-budgeted prompt context"""
+
+    def test_token_estimates(self):
+        """Test local token counting and truncation"""
+        self.assertEqual(count_tokens("I'm okay"), 4)
+        self.assertEqual(count_tokens("overwhelmed"), 3)
+        self.assertEqual(truncate_tokens("one two three four", 3), "one two…")
+        self.assertEqual(truncate_tokens("one two", 5), "one two")
+
+    def test_memory_keeps_latest_turns_within_budget(self):
+        """Test that older exchanges are dropped, and returned, to stay within the token budget"""
+        memory = ConversationMemory(user_id="user123", max_tokens=15)
+        self.assertEqual(memory.add_exchange("first " * 6, "ok"), [])
+        dropped = memory.add_exchange("second " * 6, "ok")
+
+        self.assertEqual(len(dropped), 1)
+        self.assertTrue(dropped[0][0].startswith("first"))
+        self.assertIn("second", memory.get_context_summary())
+        self.assertLessEqual(memory.token_count(), 15)
+
+    def test_long_message_truncated(self):
+        """Test that one very long message can't exceed its share of the budget"""
+        memory = ConversationMemory(user_id="user123", max_tokens=20)
+        memory.add_exchange("word " * 500, "ok")
+        self.assertLessEqual(memory.token_count(), 20)
+
+    def test_summary_folds_and_stays_within_budget(self):
+        """Test that dropped exchanges become summary lines, oldest removed first"""
+        builder = ContextBuilder(history_tokens=100, summary_tokens=20)
+        summary = builder.fold('', [("I lost my job today. It was awful.", "I'm sorry")])
+        self.assertEqual(summary, "- User said: I lost my job today.")
+
+        summary = builder.fold(summary, [("My sister called me", "That's good")])
+        self.assertEqual(summary.split('\n'), ["- User said: My sister called me"])
+
+        memory = ConversationMemory(user_id="user123")
+        self.assertIn("Earlier in the conversation:\n- User said", builder.history(summary, memory))
+        self.assertEqual(builder.history('', memory), memory.get_context_summary())
+
+
+class TestRetrievalMemory(unittest.TestCase):
+    """Test relevance search over a user's stored exchanges"""
+
+    def setUp(self):
+        self.retrieval = RetrievalMemory(max_entries=4)
+        self.retrieval.seed('user1', [
+            {'user_message': 'My sister and I argued about money again', 'bot_response': 'That sounds hard'},
+            {'user_message': 'Work deadlines are piling up', 'bot_response': 'That is a lot'},
+            {'user_message': 'I walked the dog this morning', 'bot_response': 'Nice'},
+        ])
+
+    def test_most_similar_first(self):
+        """Test that the exchange sharing the most words ranks first"""
+        results = self.retrieval.search('user1', 'I argued with my sister', top_k=2)
+        self.assertEqual(results[0][1]['user_message'], 'My sister and I argued about money again')
+        self.assertEqual(len(results), 1)  # the others share no words
+        self.assertAlmostEqual(self.retrieval.search('user1', 'Work deadlines are piling up', 1)[0][0], 1.0)
+
+    def test_exclude_recent_and_unknown_user(self):
+        """Test that the newest exchanges can be left out and unindexed users report a miss"""
+        self.assertEqual(self.retrieval.search('user1', 'walked the dog', top_k=2, exclude_recent=1), [])
+        self.assertIsNone(self.retrieval.search('user2', 'anything', top_k=2))
+
+    def test_incremental_add_bounded(self):
+        """Test that saved exchanges are indexed and the oldest fall out past max_entries"""
+        self.retrieval.add('user1', {'user_message': 'Therapy session went well', 'bot_response': 'Great'})
+        self.retrieval.add('user1', {'user_message': 'Feeling calmer', 'bot_response': 'Good'})
+
+        self.assertEqual(self.retrieval.search('user1', 'how was therapy', 1)[0][1]['user_message'],
+                         'Therapy session went well')
+        self.assertEqual(self.retrieval.search('user1', 'sister argued', 1), [])
+        self.assertEqual(self.retrieval.stats()['entries'], 4)
+
+    def test_session_manager_seeds_once(self):
+        """Test that the stored history is read once per user and disabled retrieval finds nothing"""
+        db = Mock()
+        stored = Mock()
+        stored.to_dict.return_value = {'user_message': 'My sister called', 'bot_response': 'Nice'}
+        db.collection.return_value.where.return_value.order_by.return_value.limit.return_value.stream.return_value = [stored]
+        manager = UserSessionManager(db, retrieval_top_k=2)
+
+        self.assertEqual(manager.find_related_exchanges('user1', 'sister')[0]['user_message'], 'My sister called')
+        manager.find_related_exchanges('user1', 'sister')
+        self.assertEqual(db.collection.return_value.where.call_count, 1)
+        self.assertEqual(UserSessionManager(db, retrieval_top_k=0).find_related_exchanges('user1', 'sister'), [])
+
+    def test_related_exchanges_in_history(self):
+        """Test that related exchanges are shown between the summary and the latest turns"""
+        memory = ConversationMemory(user_id="user1")
+        memory.add_exchange("Hello", "Hi")
+        history = ContextBuilder().history("- User said: hi", memory, [
+            {'user_message': 'My sister called', 'bot_response': 'Nice'}
+        ])
+
+        self.assertLess(history.index('Earlier'), history.index('Related earlier messages'))
+        self.assertLess(history.index('My sister called / You replied: Nice'), history.index('Human: Hello'))
+
+
 class TestEmpathibot(unittest.TestCase):
     """Test the main Empathibot class"""
 
@@ -289,6 +1181,22 @@ class TestEmpathibot(unittest.TestCase):
         self.assertEqual(sentiment['sentiment'], 'negative')
         self.assertGreater(sentiment['score'], 0)
 
+    def test_warm_up_reports_component_timings(self):
+        """Test that warm-up loads lazy components and times each of them"""
+        timings = self.empathibot.warm_up()
+
+        self.assertEqual(set(timings), {'langdetect_profiles', 'crisis_detector'})
+        self.assertTrue(all(elapsed >= 0 for elapsed in timings.values()))
+        self.assertIsNotNone(langdetect.detector_factory._factory)
+
+    def test_sentiment_analysis_memoized(self):
+        """Test that repeated messages reuse the cached sentiment"""
+        first = self.empathibot._analyze_sentiment("I'm sad")
+        second = self.empathibot._analyze_sentiment("i'm SAD")
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.empathibot.sentiment_cache.stats()['hits'], 1)
+
     def test_sentiment_analysis_neutral(self):
         """Test sentiment analysis for neutral messages"""
         text = "The weather is okay today"
@@ -330,6 +1238,150 @@ class TestEmpathibot(unittest.TestCase):
         # Verify conversation was saved
         mock_save.assert_called_once()
 
+    @patch.object(UserSessionManager, 'get_or_create_user')
+    @patch.object(UserSessionManager, 'get_conversation_history')
+    @patch.object(UserSessionManager, 'save_conversation')
+    @patch.object(UserSessionManager, 'update_user_activity')
+    def test_conversation_memory_persists(self, mock_update, mock_save, mock_history, mock_get_user):
+        """Test that the memory is built from history once and then updated after each reply"""
+        mock_get_user.return_value = {
+            'id': 'user123', 'phone_number': "whatsapp:+1", 'user_profile': {}, 'mental_health_data': {}
+        }
+        mock_history.return_value = [{'user_message': 'Earlier', 'bot_response': 'Before'}]
+        self.mock_db.collection.return_value.document.return_value.get.return_value.to_dict.return_value = {}
+
+        self.empathibot.process_message("whatsapp:+1", "Hello there")
+        self.empathibot.process_message("whatsapp:+1", "Still here")
+
+        mock_history.assert_called_once()
+        context = self.empathibot.conversation_memories.get('user123').get_context_summary()
+        self.assertIn('Earlier', context)
+        self.assertIn('Human: Still here', context)
+        self.assertNotIn('Context:', context)
+
+    @patch.object(UserSessionManager, 'get_or_create_user')
+    @patch.object(UserSessionManager, 'get_conversation_history')
+    @patch.object(UserSessionManager, 'save_conversation')
+    @patch.object(UserSessionManager, 'update_user_activity')
+    def test_prompt_budget_and_summary(self, mock_update, mock_save, mock_history, mock_get_user):
+        """Test that long turns are folded into the stored summary and prompt tokens are recorded"""
+        mock_get_user.return_value = {
+            'id': 'user123', 'phone_number': "whatsapp:+1", 'user_profile': {}, 'mental_health_data': {}
+        }
+        mock_history.return_value = []
+        self.mock_db.collection.return_value.document.return_value.get.return_value.to_dict.return_value = {}
+        self.empathibot.context_builder = ContextBuilder(history_tokens=60, summary_tokens=50)
+
+        self.empathibot.process_message("whatsapp:+1", "Work was long today. " + "really " * 40)
+        self.empathibot.process_message("whatsapp:+1", "Dinner with family. " + "nice " * 40)
+
+        summary_updates = [call[0][1] for call in self.mock_db.batch.return_value.update.call_args_list
+                           if 'conversation_summary' in call[0][1]]
+        self.assertEqual(summary_updates[-1]['conversation_summary'], "- User said: Work was long today.")
+        stats = self.empathibot.get_prompt_token_stats()
+        self.assertEqual(stats['count'], 2)
+        self.assertLess(stats['max'], count_tokens(self.empathibot.prompt_template.template) + 150)
+
+    @patch.object(UserSessionManager, 'get_conversation_history')
+    def test_message_writes_single_commit(self, mock_history):
+        """Test that a cached user's message is persisted with one batch commit and no other writes"""
+        phone = "whatsapp:+1234567890"
+        mock_history.return_value = []
+        profile = {
+            'phone_number': phone,
+            'history_count': 3,
+            'user_profile': {},
+            'mental_health_data': {'risk_level': 'low'}
+        }
+        self.empathibot.session_manager.sessions.put('user123', {'id': 'user123', **profile})
+        self.mock_db.collection.return_value.document.return_value.get.return_value.to_dict.return_value = profile
+
+        self.empathibot.process_message(phone, "Hello, I'm feeling okay today")
+
+        batch = self.mock_db.batch.return_value
+        batch.commit.assert_called_once()
+        self.assertEqual(batch.set.call_count, 1)  # the message
+        self.mock_db.collection.return_value.add.assert_not_called()
+        self.mock_db.collection.return_value.document.return_value.update.assert_not_called()
+        # The profile read and the commit; the patched history query would be the only other round trip
+        self.assertEqual(self.empathibot.get_round_trip_stats()['max'], 2)
+        user = self.empathibot.session_manager.sessions.get('user123')
+        self.assertEqual(user['history_count'], 4)
+        self.assertEqual(len(mood_trend_entries(user['mental_health_data'])), 1)
+
+    @patch.object(UserSessionManager, 'get_conversation_history')
+    def test_cached_user_state_read_fresh(self, mock_history):
+        """Test that fields written back per message start from Firestore, not the cached profile"""
+        phone = "whatsapp:+1234567890"
+        mock_history.return_value = []
+        stored_risk = {'score': 80.0, 'updated_at': time.time()}
+        self.empathibot.session_manager.sessions.put('user123', {
+            'id': 'user123', 'phone_number': phone, 'user_profile': {},
+            'mental_health_data': {'rolling_risk': {'score': 0.0, 'updated_at': time.time()}}
+        })
+        self.mock_db.collection.return_value.document.return_value.get.return_value.to_dict.return_value = {
+            'phone_number': phone, 'user_profile': {}, 'mental_health_data': {'rolling_risk': stored_risk}
+        }
+
+        self.empathibot.process_message(phone, "Hello, I'm feeling okay today")
+
+        risk = [call[0][1]['mental_health_data.rolling_risk']
+                for call in self.mock_db.batch.return_value.update.call_args_list
+                if 'mental_health_data.rolling_risk' in call[0][1]]
+        self.assertGreaterEqual(risk[0]['score'], 79)
+
+    @patch.object(UserSessionManager, 'get_conversation_history')
+    def test_failed_commit_drops_conversation_memory(self, mock_history):
+        """Test that a failed batch commit leaves no unsaved exchange in the live memory"""
+        phone = "whatsapp:+1234567890"
+        mock_history.return_value = []
+        profile = {'phone_number': phone, 'user_profile': {}, 'mental_health_data': {}}
+        self.empathibot.session_manager.sessions.put('user123', {'id': 'user123', **profile})
+        self.mock_db.collection.return_value.document.return_value.get.return_value.to_dict.return_value = profile
+        self.mock_db.batch.return_value.commit.side_effect = RuntimeError("unavailable")
+
+        with self.assertRaises(RuntimeError):
+            self.empathibot.process_message(phone, "Hello, I'm feeling okay today")
+
+        self.assertIsNone(self.empathibot.conversation_memories.get('user123'))
+        self.assertIsNone(self.empathibot.session_manager.sessions.get('user123'))
+
+    @patch.object(UserSessionManager, 'get_or_create_user')
+    @patch.object(UserSessionManager, 'get_conversation_history')
+    @patch.object(UserSessionManager, 'save_conversation')
+    @patch.object(UserSessionManager, 'update_user_activity')
+    def test_crisis_phrase_in_another_language(self, mock_update, mock_save, mock_history, mock_get_user):
+        """Test that Spanish crisis phrases are caught in an English user's conversation"""
+        mock_get_user.return_value = {
+            'id': 'user123', 'phone_number': "whatsapp:+1", 'preferred_language': 'en',
+            'user_profile': {}, 'mental_health_data': {}
+        }
+        mock_history.return_value = []
+        self.mock_db.collection.return_value.document.return_value.get.return_value.to_dict.return_value = {}
+        detector = self.empathibot.crisis_detector
+
+        for message in ["sin esperanza", "no puedo mas"]:
+            response = self.empathibot.process_message("whatsapp:+1", message)
+            self.assertEqual(response, detector.get_crisis_response('high'), f"Missed '{message}'")
+
+    @patch.object(UserSessionManager, 'get_or_create_user')
+    @patch.object(UserSessionManager, 'save_conversation')
+    @patch.object(UserSessionManager, 'update_user_activity')
+    def test_crisis_alert_in_batch(self, mock_update, mock_save, mock_get_user):
+        """Test that the crisis alert is written in the message's batch"""
+        mock_get_user.return_value = {
+            'id': 'user123', 'phone_number': "whatsapp:+1", 'user_profile': {}, 'mental_health_data': {}
+        }
+        self.mock_db.collection.return_value.document.return_value.get.return_value.to_dict.return_value = {}
+
+        self.empathibot.process_message("whatsapp:+1", "I want to kill myself")
+
+        batch = self.mock_db.batch.return_value
+        batch.set.assert_called_once()
+        self.assertEqual(batch.set.call_args[0][1]['severity'], 'critical')
+        batch.commit.assert_called_once()
+        self.assertIs(mock_save.call_args[1]['batch'], batch)
+
     @patch.object(UserSessionManager, 'get_or_create_user')
     @patch.object(UserSessionManager, 'save_conversation')
     @patch.object(UserSessionManager, 'update_user_activity')
@@ -362,6 +1414,54 @@ class TestEmpathibot(unittest.TestCase):
         # Verify crisis alert was logged
         self.mock_db.collection.assert_called()
 
+    @patch.object(UserSessionManager, 'get_or_create_user')
+    @patch.object(UserSessionManager, 'save_conversation')
+    @patch.object(UserSessionManager, 'update_user_activity')
+    def test_rolling_risk_escalates_to_crisis(self, mock_update, mock_save, mock_get_user):
+        """Test that a moderate message on top of recent moderate ones takes the crisis path"""
+        phone = "whatsapp:+1234567890"
+        mock_get_user.return_value = {
+            'id': 'user123',
+            'phone_number': phone,
+            'user_profile': {},
+            'mental_health_data': {'rolling_risk': {'score': 80.0, 'updated_at': time.time()}}
+        }
+
+        mock_collection = Mock()
+        mock_collection.document.return_value.get.return_value.to_dict.return_value = {}
+        self.mock_db.collection.return_value = mock_collection
+
+        response = self.empathibot.process_message(phone, "I'm so overwhelmed")
+
+        self.assertIn('988', response)
+        alert = self.mock_db.batch.return_value.set.call_args[0][1]
+        self.assertEqual(alert['severity'], 'high')
+        self.assertGreaterEqual(alert['rolling_risk_score'], 90)
+        self.assertEqual(mock_update.call_args.kwargs['rolling_risk']['score'], 0.0)
+
+    @patch.object(UserSessionManager, 'get_or_create_user')
+    @patch.object(UserSessionManager, 'get_conversation_history', return_value=[])
+    @patch.object(UserSessionManager, 'save_conversation')
+    @patch.object(UserSessionManager, 'update_user_activity')
+    def test_language_profile_saved(self, mock_update, mock_save, mock_history, mock_get_user):
+        """Test that the sticky language profile is used and written back"""
+        mock_get_user.return_value = {
+            'id': 'user123',
+            'phone_number': "whatsapp:+1234567890",
+            'preferred_language': 'es',
+            'language_profile': {'distribution': {'es': 0.9}, 'messages': 4, 'since_check': 0,
+                                 'script': 'latin'},
+            'mental_health_data': {}
+        }
+        mock_collection = Mock()
+        mock_collection.document.return_value.get.return_value.to_dict.return_value = {}
+        self.mock_db.collection.return_value = mock_collection
+
+        self.empathibot.process_message("whatsapp:+1234567890", "Hello, how are you feeling today?")
+
+        self.assertEqual(mock_update.call_args[0][1], 'es')
+        self.assertEqual(mock_update.call_args.kwargs['language_profile']['since_check'], 1)
+
     def test_check_in_message_generation(self):
         """Test wellness check-in message generation"""
         # Mock user document
@@ -413,6 +1513,62 @@ class TestEmpathibot(unittest.TestCase):
         self.assertIn('mood_trend', insights)
 
 
+class TestMoodTrend(unittest.TestCase):
+    """Test the mood trend entries keyed by write time"""
+
+    def test_entries_in_write_order(self):
+        """Test that entries come back oldest first, keeping only the last MOOD_TREND_SIZE"""
+        keys = [mood_entry_key(1_760_000_000_000_000_000 + i * 1_000_000_000) for i in range(45)]
+        stored = {key: {'n': i} for i, key in enumerate(keys)}
+        shuffled = dict(random.Random(7).sample(list(stored.items()), len(stored)))
+        entries = mood_trend_entries({'mood_entries': shuffled})
+
+        self.assertEqual([entry['n'] for entry in entries], list(range(45 - MOOD_TREND_SIZE, 45)))
+
+    def test_legacy_list_comes_first(self):
+        """Test that entries of the older mood_trend list precede keyed entries"""
+        data = {'mood_trend': [{'n': 'old'}],
+                'mood_entries': {mood_entry_key(2): {'n': 1}, mood_entry_key(1): {'n': 0}}}
+        self.assertEqual([entry['n'] for entry in mood_trend_entries(data)], ['old', 0, 1])
+        self.assertEqual(mood_trend_entries({}), [])
+
+    def test_append_is_a_blind_write(self):
+        """Test that appending adds a new key and deletes the oldest without reading the user"""
+        db = Mock()
+        empathibot = Empathibot(db=db, llm=FakeListLLM(responses=["ok"]))
+        keys = [mood_entry_key(i) for i in range(MOOD_TREND_SIZE + 1)]
+        stored = {'mood_trend': [{'n': 'old'}], 'mood_entries': {key: {} for key in keys}}
+
+        empathibot._update_mood_tracking('user123', {'sentiment': 'positive'}, {'severity': 'low'},
+                                         mental_health_data=stored)
+
+        user_ref = db.collection.return_value.document.return_value
+        user_ref.get.assert_not_called()
+        fields = user_ref.update.call_args[0][0]
+        deleted = {path for path, value in fields.items() if value is firestore.DELETE_FIELD}
+        self.assertEqual(deleted, {f'mental_health_data.mood_entries.{key}' for key in keys[:2]}
+                         | {'mental_health_data.mood_trend'})
+        added = [value for path, value in fields.items() if value is not firestore.DELETE_FIELD]
+        self.assertEqual([entry['sentiment'] for entry in added], ['positive'])
+
+    def test_concurrent_appends_both_kept(self):
+        """Test that two messages written from the same stored state don't overwrite each other"""
+        db = Mock()
+        empathibot = Empathibot(db=db, llm=FakeListLLM(responses=["ok"]))
+        stored = {'mood_entries': {mood_entry_key(1): {'sentiment': 'neutral'}}}
+
+        for sentiment in ('positive', 'negative'):
+            empathibot._update_mood_tracking('user123', {'sentiment': sentiment}, {'severity': 'low'},
+                                             mental_health_data=stored)
+
+        user_ref = db.collection.return_value.document.return_value
+        written = dict(stored['mood_entries'])
+        for call in user_ref.update.call_args_list:
+            written.update({path.rsplit('.', 1)[1]: value for path, value in call[0][0].items()})
+        self.assertEqual([entry['sentiment'] for entry in mood_trend_entries({'mood_entries': written})],
+                         ['neutral', 'positive', 'negative'])
+
+
 class TestIntegration(unittest.TestCase):
     """Integration tests for the complete system"""
 
@@ -457,6 +1613,7 @@ class TestIntegration(unittest.TestCase):
             "I think I need help"
         ]
 
+        chain = empathibot.conversation_chain
         for msg in messages:
             response = empathibot.process_message(phone, msg)
             self.assertIsNotNone(response)
@@ -464,6 +1621,9 @@ class TestIntegration(unittest.TestCase):
 
         # Verify all messages were saved
         self.assertEqual(mock_save.call_count, len(messages))
+        # The chain is built once and reused, with each message's history passed in
+        self.assertIs(empathibot.conversation_chain, chain)
+        self.assertIsNone(chain.memory)
 
 
 def run_tests():
@@ -474,10 +1634,22 @@ def run_tests():
 
     # Add all test classes
     suite.addTests(loader.loadTestsFromTestCase(TestCrisisDetector))
+    suite.addTests(loader.loadTestsFromTestCase(TestCrisisLexicon))
+    suite.addTests(loader.loadTestsFromTestCase(TestResultCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestProfileCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestConversationWindowCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestFuzzyCrisisMatching))
+    suite.addTests(loader.loadTestsFromTestCase(TestCrisisCascade))
+    suite.addTests(loader.loadTestsFromTestCase(TestRollingRiskTracker))
+    suite.addTests(loader.loadTestsFromTestCase(TestBenchmarkGates))
+    suite.addTests(loader.loadTestsFromTestCase(TestSentimentAnalyzer))
     suite.addTests(loader.loadTestsFromTestCase(TestLanguageHandler))
     suite.addTests(loader.loadTestsFromTestCase(TestUserSessionManager))
     suite.addTests(loader.loadTestsFromTestCase(TestConversationMemory))
+    suite.addTests(loader.loadTestsFromTestCase(TestContextBuilder))
+    suite.addTests(loader.loadTestsFromTestCase(TestRetrievalMemory))
     suite.addTests(loader.loadTestsFromTestCase(TestEmpathibot))
+    suite.addTests(loader.loadTestsFromTestCase(TestMoodTrend))
     suite.addTests(loader.loadTestsFromTestCase(TestIntegration))
 
     # Run tests